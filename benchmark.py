@@ -0,0 +1,307 @@
+"""
+Benchmarks for the compiler and the player on generated shows.
+
+Shows are generated from a handful of sizes: how many sections there are, how
+many entries each has, how often they repeat, how many times each one comes up
+and how many channels there are. For every show this measures how fast it
+compiles with and without a warm cache, how much memory compiling takes at its
+peak, how long the lightmap takes to open and read through and how late frames
+are released when the player runs it against fake music.
+
+Results are written as JSON, so runs from different commits can be compared
+with --compare.
+
+With --check, shows are compiled and validated against their maps instead, as
+lightmaps and section maps and with and without numpy, which makes sure the
+different ways of working out frames agree.
+"""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from io import StringIO
+from itertools import product
+from json import dump, load
+from os import makedirs, remove, replace
+from os.path import getsize, isdir
+from platform import python_version
+from random import Random
+from shutil import rmtree
+from struct import pack
+from tempfile import mkdtemp
+from time import perf_counter, strftime
+from tracemalloc import get_traced_memory, start as start_tracing, \
+    stop as stop_tracing
+from wave import open as open_wave
+
+import lights
+from lightmap import load_numpy
+from sectionmap import open_lightmap
+
+# name: (sections, entries, repeat, times, channels)
+SUITE = {
+    "small": (10, 8, 2, 4, 13),
+    "medium": (100, 16, 4, 8, 13),
+    "large": (1000, 16, 4, 8, 13),
+    "wide": (100, 16, 4, 8, 256),
+}
+
+# Sizes of the shows --check compiles, the same as the suite's. Few channels
+# with lots of entries crowd frames together, which is where the ways of
+# working out frames are most likely to disagree.
+CHECK_SIZES = [(40, 30, 2, 10, 3), (20, 12, 3, 4, 13), (10, 8, 2, 4, 256)]
+
+# Tempo the generated sections are written in.
+BPM = 120
+# Rate of the silent music generated for shows. Only its length matters.
+MUSIC_RATE = 1000
+
+
+# Writes a show named name into folder with sections sections of entries
+# entries each, repeated repeat times and coming up times times, on channels
+# channels. Sections are split over two map files. Returns how long the show
+# is in seconds.
+def generate_show(folder, name, sections, entries, repeat, times, channels,
+                  seed=0):
+    rng = Random(seed)
+    path = "{}/{}".format(folder, name)
+    makedirs(path, exist_ok=True)
+    length = 8  # Beats in a section before it repeats
+    section_seconds = repeat * length * 60 / BPM
+    # Roughly four sections play at once.
+    song_length = max(sections * times * section_seconds / 4, section_seconds)
+    maps = ["a.map", "b.map"]
+    files = [[], []]
+    for i in range(sections):
+        lines = files[i % 2]
+        lines.append("section: S{}".format(i))
+        lines.append("bpm: {}".format(BPM))
+        lines.append("repeat: {} b {}".format(repeat, length))
+        for j in range(times):
+            lines.append("time: {}".format(
+                round(rng.uniform(0, song_length - section_seconds), 3)))
+        for j in range(entries):
+            # Mostly on and off, with some random and some unchanged.
+            mode = rng.choice((3, 3, 3, 1, 1, 2, 0))
+            lines.append("[{}, {}, {}, {}]".format(
+                rng.randint(1, channels), mode,
+                round(rng.uniform(0, length), 2),
+                round(rng.choice((0.25, 0.5, 1, 2)), 2)))
+    for filename, lines in zip(maps, files):
+        with open("{}/{}".format(path, filename), "w") as out:
+            out.write("\n".join(lines) + "\n")
+    with open("{}/{}.{}".format(path, name, lights.extension), "w") as out:
+        out.write("[Music]\ncompiled = false\nlightmap = {}.lm\n"
+                  "music = {}.wav\n\n[Compile]\n".format(name, name))
+        for i, filename in enumerate(maps):
+            out.write("map{} = {}\n".format(i, filename))
+    with open_wave("{}/{}.wav".format(path, name), "wb") as music:
+        music.setnchannels(1)
+        music.setsampwidth(1)
+        music.setframerate(MUSIC_RATE)
+        music.writeframes(pack("B", 128) * int(
+            (song_length + 2) * MUSIC_RATE))
+    return song_length
+
+
+# Generates one show, benchmarks it and returns the results.
+def run_scenario(folder, name, sections, entries, repeat, times, channels,
+                 seed=0):
+    song_length = generate_show(folder, name, sections, entries, repeat,
+                                times, channels, seed)
+    path = "{}/{}".format(folder, name)
+    song = lights.Song(name, path)
+    lights.ord_count = channels
+    result = {
+        "name": name, "sections": sections, "entries": entries,
+        "repeat": repeat, "times": times, "channels": channels,
+        "song_seconds": round(song_length, 3),
+        "events": sections * entries * repeat * times * 2,
+    }
+    messages = StringIO()
+    with redirect_stdout(messages):
+        start = perf_counter()
+        ok = lights.compile_song(song)
+        result["compile_cold"] = perf_counter() - start
+        start = perf_counter()
+        ok = ok and lights.compile_song(song)
+        result["compile_warm"] = perf_counter() - start
+    if not ok:
+        print(messages.getvalue().rstrip())
+        return None
+    result["events_per_second"] = result["events"] / result["compile_cold"]
+    # Memory is traced on a separate cold compile since tracing slows it
+    # down.
+    remove("{}/.{}.cache".format(path, name))
+    start_tracing()
+    with redirect_stdout(messages):
+        lights.compile_song(song)
+    result["peak_megabytes"] = get_traced_memory()[1] / 1000000
+    stop_tracing()
+    lightmap_file = "{}/{}".format(path, song.lights)
+    result["lightmap_bytes"] = getsize(lightmap_file)
+    start = perf_counter()
+    with open_lightmap(lightmap_file) as lightmap:
+        result["load"] = perf_counter() - start
+        result["frames"] = len(lightmap)
+        start = perf_counter()
+        for frame in lightmap.stream(lights.light_probability, seed):
+            pass
+        result["stream"] = perf_counter() - start
+    result["frames_per_second"] = result["frames"] / max(result["stream"],
+                                                         1e-9)
+    # The player's own work takes real time, but waiting for frames is
+    # skipped.
+    with redirect_stdout(messages):
+        simulation = lights.simulate_song(song, step=None)
+    if simulation is None or not simulation.ok:
+        print(messages.getvalue().rstrip())
+        return None
+    result["late"] = simulation.timing.summary()["late"]
+    for key, value in result.items():
+        if isinstance(value, float):
+            result[key] = round(value, 6)
+    return result
+
+
+# Generates seeds shows of every one of CHECK_SIZES in folder, compiles each
+# as a lightmap and a section map, with and without numpy, and validates it.
+# Prints every problem and returns how many compiles had any.
+def check_shows(folder, seeds):
+    failed = 0
+    for seed, (i, size) in product(range(seeds), enumerate(CHECK_SIZES)):
+        name = "check{}_{}".format(i, seed)
+        generate_show(folder, name, *size, seed=seed)
+        song = lights.Song(name, "{}/{}".format(folder, name))
+        lights.ord_count = size[4]
+        for instancing, use_numpy in product((False, True), repeat=2):
+            lights.section_instancing = instancing
+            lights.use_numpy = use_numpy
+            messages = StringIO()
+            with redirect_stdout(messages):
+                compiled = lights.compile_song(song)
+            if compiled:
+                problems = lights.validate_song(song)
+            else:
+                problems = [messages.getvalue().rstrip()]
+            if problems:
+                failed += 1
+                print("{} ({}, {}):".format(
+                    name, instancing and "section map" or "lightmap",
+                    use_numpy and "numpy" or "no numpy"))
+                for problem in problems:
+                    print("    " + problem)
+    return failed
+
+
+# Prints how every measurement changed from an earlier run, as new / old.
+def compare(results, old):
+    old = {result["name"]: result for result in old["scenarios"]}
+    for result in results["scenarios"]:
+        before = old.get(result["name"])
+        if before is None:
+            continue
+        print("{}:".format(result["name"]))
+        for key in ("compile_cold", "compile_warm", "peak_megabytes",
+                    "lightmap_bytes", "load", "stream"):
+            if before.get(key):
+                print("    {} {} -> {} ({}x)".format(
+                    key, before[key], result[key],
+                    round(result[key] / before[key], 3)))
+        for key in ("p50", "p99"):
+            was = before["late"][key]
+            now = result["late"][key]
+            print("    late {} {} -> {}".format(key, was, now))
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Benchmark the compiler and player "
+                                        "on generated shows.")
+    parser.add_argument("scenarios", nargs="*",
+                        help="scenarios from the suite to run, default all "
+                             "of them: " + ", ".join(SUITE))
+    parser.add_argument("--custom", nargs=5, type=int,
+                        metavar=("SECTIONS", "ENTRIES", "REPEAT", "TIMES",
+                                 "CHANNELS"),
+                        help="run a single show of this size instead")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--label", default="",
+                        help="saved with the results, like a commit hash")
+    parser.add_argument("--output", help="JSON file to save the results to")
+    parser.add_argument("--compare", help="JSON file of earlier results to "
+                                          "compare against")
+    parser.add_argument("--keep", help="folder to generate the shows in and "
+                                       "keep them, default a temporary one")
+    parser.add_argument("--instance-sections", action="store_true",
+                        help="compile section maps instead of lightmaps")
+    parser.add_argument("--check", type=int, metavar="SEEDS",
+                        help="compile and validate this many shows of every "
+                             "check size instead of benchmarking")
+    args = parser.parse_args(argv)
+    if args.custom is not None:
+        scenarios = {"custom": tuple(args.custom)}
+    else:
+        for name in args.scenarios:
+            if name not in SUITE:
+                print("Unknown scenario {}.".format(name))
+                return 1
+        scenarios = {name: SUITE[name] for name in args.scenarios or SUITE}
+    folder = args.keep
+    if folder is None:
+        folder = mkdtemp(prefix="lights-bench-")
+    elif not isdir(folder):
+        makedirs(folder)
+    channels = lights.ord_count
+    if args.check is not None:
+        use_numpy = lights.use_numpy
+        try:
+            failed = check_shows(folder, args.check)
+        finally:
+            lights.ord_count = channels
+            lights.use_numpy = use_numpy
+            if args.keep is None:
+                rmtree(folder, ignore_errors=True)
+        print("{} of {} compiles checked out.".format(
+            args.check * len(CHECK_SIZES) * 4 - failed,
+            args.check * len(CHECK_SIZES) * 4))
+        return failed and 1 or 0
+    lights.section_instancing = args.instance_sections
+    results = {
+        "label": args.label,
+        "instance_sections": args.instance_sections,
+        "date": strftime("%Y-%m-%d %H:%M:%S"),
+        "python": python_version(),
+        "numpy": load_numpy() is not None,
+        "scenarios": [],
+    }
+    try:
+        for name, size in scenarios.items():
+            print("Running {}...".format(name))
+            result = run_scenario(folder, name, *size, seed=args.seed)
+            if result is None:
+                print("{} failed.".format(name))
+                return 1
+            results["scenarios"].append(result)
+            print("    {} events compiled in {} seconds ({} warm), {} MB "
+                  "peak, {} frames read in {} seconds, frames {} ms late at "
+                  "the 99th percentile.".format(
+                      result["events"], result["compile_cold"],
+                      result["compile_warm"],
+                      round(result["peak_megabytes"], 1), result["frames"],
+                      result["stream"],
+                      round(result["late"]["p99"] * 1000, 3)))
+    finally:
+        lights.ord_count = channels
+        if args.keep is None:
+            rmtree(folder, ignore_errors=True)
+    if args.output is not None:
+        with open(args.output + ".tmp", "w") as out:
+            dump(results, out, indent=1)
+        replace(args.output + ".tmp", args.output)
+    if args.compare is not None:
+        with open(args.compare, "r") as data:
+            compare(results, load(data))
+    return 0
+
+
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,79 @@
+"""
+Incremental compile cache.
+
+Keeps the parsed contents of every map file, keyed by a hash of the file, and
+the expanded, sorted events of every section, keyed by a hash of the section
+definition. A recompile only has to reparse the map files that changed and
+reexpand the sections whose definition changed.
+"""
+
+from hashlib import sha1
+from os import replace, stat
+from pickle import dump, load, UnpicklingError
+
+# Bump this whenever the layout of cached map or section data changes.
+CACHE_VERSION = 3
+
+
+class CompileCache:
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.sections = {}
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(path, "rb") as data:
+                version, files, sections = load(data)
+            if version == CACHE_VERSION:
+                self.files = files
+                self.sections = sections
+        # A cache written with numpy can't be read back without it.
+        except (OSError, EOFError, UnpicklingError, ValueError, TypeError,
+                AttributeError, ImportError):
+            pass
+        # Only entries used by this compile get saved back.
+        self.used_files = {}
+        self.used_sections = {}
+
+    # Returns whatever parse returns for the lines of the map file, reusing
+    # the cached result if the file hasn't changed.
+    def map_file(self, path, parse):
+        info = stat(path)
+        cached = self.files.get(path)
+        if cached is not None and cached[0] == info.st_mtime_ns and \
+                cached[1] == info.st_size:
+            self.used_files[path] = cached
+            self.hits += 1
+            return cached[3]
+        with open(path, "rb") as data:
+            raw = data.read()
+        digest = sha1(raw).hexdigest()
+        if cached is not None and cached[2] == digest:
+            result = cached[3]
+            self.hits += 1
+        else:
+            result = parse(raw.decode("utf-8").splitlines())
+            self.misses += 1
+        self.used_files[path] = (info.st_mtime_ns, info.st_size, digest,
+                                 result)
+        return result
+
+    # Returns whatever expand returns for the section, reusing the cached
+    # result if the section definition is the same.
+    def section(self, name, definition, expand):
+        digest = sha1(repr(definition).encode("utf-8")).hexdigest()
+        cached = self.sections.get(name)
+        if cached is not None and cached[0] == digest:
+            result = cached[1]
+            self.hits += 1
+        else:
+            result = expand()
+            self.misses += 1
+        self.used_sections[name] = (digest, result)
+        return result
+
+    def save(self):
+        with open(self.path + ".tmp", "wb") as out:
+            dump((CACHE_VERSION, self.used_files, self.used_sections), out)
+        replace(self.path + ".tmp", self.path)
@@ -0,0 +1,354 @@
+"""
+Per channel interval sets for working out what the lights do.
+
+Every entry of a show holds its light on, random or off for a while. A
+channel's on entries and its random entries are each merged into a sorted set
+of intervals, and what the channel does at any frame comes from those sets:
+on overrules random and random overrules off. Since a channel only ever looks
+at its own entries, channels can be worked out separately and in any order,
+and the states they end up with can be looked up at any time with a binary
+search.
+
+Holding the interval sets of a whole show takes memory that grows with its
+length, so shows are compiled and played with a FrameResolver, which works out
+the same states a frame at a time. The interval sets are only built for
+checking a compiled lightmap against its maps.
+
+Both follow the rule in frame_state. resolve_channel and the general path of
+FrameResolver call it, while resolve_channel_array and the single event path
+of FrameResolver spell it out for speed and have to be kept the same by hand.
+Since checking a lightmap compares one against the other, benchmark.py --check
+compiles and checks generated shows with and without numpy to make sure they
+agree.
+"""
+
+from array import array
+from bisect import bisect_right
+from lightmap import load_numpy
+
+# Bits of modes in the bit sets of modes starting or showing in a frame.
+RANDOM = 1 << 2
+ON = 1 << 3
+
+
+# What a channel does in a frame, which every way of working out states goes
+# by. on and random are whether an on or random entry from this or an earlier
+# frame holds the light past the frame, and starting and showing are bit sets
+# of the modes starting in the frame and lasting past it. On overrules random
+# and random overrules off. A light still held on or random is left alone
+# unless another entry like that starts, which returns 0.
+def frame_state(on, random, starting, showing):
+    if on:
+        return starting & ON and 3
+    if showing & ON:
+        return 3
+    if random:
+        return starting & RANDOM and 2
+    if showing & RANDOM:
+        return 2
+    return 1
+
+
+class IntervalSet:
+    # Sorted intervals from (start, end) pairs. An interval is only kept if
+    # it ends more than margin after the ones before it, so the ends go up
+    # along with the starts. Intervals aren't merged, since one that starts
+    # later doesn't hold anything before it starts, even if it touches an
+    # earlier one.
+    def __init__(self, intervals, margin=0):
+        self.margin = margin
+        self.starts = array("d")
+        self.ends = array("d")
+        reach = 0
+        for start, end in sorted(intervals):
+            if end - margin <= reach:
+                continue
+            reach = end
+            self.starts.append(start)
+            self.ends.append(end)
+
+    def __len__(self):
+        return len(self.starts)
+
+    # Furthest end of the intervals starting by time, or 0 if there are none.
+    # That's the end of the last of them, since the ends go up.
+    def reach(self, time):
+        i = bisect_right(self.starts, time)
+        return i and self.ends[i - 1] or 0
+
+    # Whether an interval that started by time lasts more than margin past
+    # it.
+    def active(self, time):
+        return self.reach(time) - self.margin > time
+
+    # Same as active for every one of times, which have to be sorted, in one
+    # pass. Returns a bytearray of flags.
+    def active_all(self, times):
+        flags = bytearray(len(times))
+        starts = self.starts
+        ends = self.ends
+        margin = self.margin
+        i = 0
+        reach = 0
+        for j, time in enumerate(times):
+            while i < len(starts) and starts[i] <= time:
+                reach = ends[i]
+                i += 1
+            if reach - margin > time:
+                flags[j] = 1
+        return flags
+
+
+class ChannelStates:
+    # The on and random intervals of a channel and the states it changes to,
+    # with the times and frame indexes it changes at.
+    def __init__(self, on, random, times, frames, states):
+        self.on = on
+        self.random = random
+        self.times = times
+        self.frames = frames
+        self.states = states
+
+    # State the channel was last set to at time, or 1 for off before it was
+    # set at all.
+    def state(self, time):
+        i = bisect_right(self.times, time)
+        return i and self.states[i - 1] or 1
+
+
+# Works out the states of a channel from its entries. times are the times of
+# the frames of the show, and every entry has the index of the frame it's in,
+# when it starts, its mode and its duration, in order of frame. Frames are
+# more than margin apart and entries start within margin of their frame, so
+# the order of entries in a frame doesn't matter.
+#
+# On and random entries hold their state from their frame for as long as
+# they last, with on overruling random and random overruling off. An entry
+# that's too short to last more than margin past its frame holds nothing,
+# but still shows in its frame if it ends after the next one starts. Mode 0
+# entries change nothing and have to be left out.
+def resolve_channel(times, frames, starts, modes, durations, margin=0):
+    # Every frame the channel has entries in, with bit sets of the modes
+    # starting and showing in it and the longest on and random entries.
+    indexes = array("I")
+    frame_times = array("d")
+    starting = bytearray()
+    showing = bytearray()
+    longest_on = array("d")
+    longest_random = array("d")
+    count = len(frames)
+    i = 0
+    while i < count:
+        index = frames[i]
+        time = times[index]
+        modes_starting = modes_showing = 0
+        on_duration = random_duration = 0
+        while i < count and frames[i] == index:
+            mode = modes[i]
+            duration = durations[i]
+            modes_starting |= 1 << mode
+            if starts[i] + duration - margin > time:
+                modes_showing |= 1 << mode
+            if mode == 3:
+                if duration > on_duration:
+                    on_duration = duration
+            elif mode == 2 and duration > random_duration:
+                random_duration = duration
+            i += 1
+        indexes.append(index)
+        frame_times.append(time)
+        starting.append(modes_starting)
+        showing.append(modes_showing)
+        longest_on.append(on_duration)
+        longest_random.append(random_duration)
+    on = IntervalSet([(time, time + duration) for time, duration in
+                      zip(frame_times, longest_on) if duration], margin)
+    on_active = on.active_all(frame_times)
+    # Random entries only hold if nothing holds the light on when they start.
+    random = IntervalSet([(time, time + duration) for time, duration, held in
+                          zip(frame_times, longest_random, on_active)
+                          if duration and not held], margin)
+    random_active = random.active_all(frame_times)
+    change_times = array("d")
+    change_frames = array("I")
+    states = array("b")
+    for j in range(len(indexes)):
+        state = frame_state(on_active[j], random_active[j], starting[j],
+                            showing[j])
+        if not state:
+            continue
+        change_times.append(frame_times[j])
+        change_frames.append(indexes[j])
+        states.append(state)
+    return ChannelStates(on, random, change_times, change_frames, states)
+
+
+# Same as resolve_channel but works frames out with numpy, taking the entries
+# and the times of the frames as arrays. Only merging the intervals is left to
+# Python.
+def resolve_channel_array(times, frames, starts, modes, durations, margin=0):
+    if not frames:
+        return ChannelStates(IntervalSet([]), IntervalSet([]), array("d"),
+                             array("I"), array("b"))
+    numpy = load_numpy()
+    frames = numpy.frombuffer(frames, dtype=numpy.uint32)
+    starts = numpy.frombuffer(starts, dtype=numpy.float64)
+    modes = numpy.frombuffer(modes, dtype=numpy.int8)
+    durations = numpy.frombuffer(durations, dtype=numpy.float64)
+    # First entry of every frame
+    firsts = numpy.flatnonzero(numpy.diff(frames)) + 1
+    firsts = numpy.concatenate(([0], firsts))
+    indexes = frames[firsts]
+    frame_times = times[indexes]
+    bits = numpy.left_shift(1, modes.astype(numpy.int32))
+    starting = numpy.bitwise_or.reduceat(bits, firsts)
+    showing = numpy.bitwise_or.reduceat(
+        numpy.where(starts + durations - margin > times[frames], bits, 0),
+        firsts)
+    longest_on = numpy.maximum.reduceat(
+        numpy.where(modes == 3, durations, 0), firsts)
+    longest_random = numpy.maximum.reduceat(
+        numpy.where(modes == 2, durations, 0), firsts)
+    held = longest_on > 0
+    on = IntervalSet(zip(frame_times[held].tolist(),
+                         (frame_times + longest_on)[held].tolist()), margin)
+    on_active = active_array(on, frame_times)
+    held = (longest_random > 0) & ~on_active
+    random = IntervalSet(zip(frame_times[held].tolist(),
+                             (frame_times + longest_random)[held].tolist()),
+                         margin)
+    random_active = active_array(random, frame_times)
+    # frame_state for every frame at once, 0 is left alone.
+    states = numpy.select(
+        [on_active, showing & ON > 0, random_active, showing & RANDOM > 0],
+        [numpy.where(starting & ON > 0, 3, 0), 3,
+         numpy.where(starting & RANDOM > 0, 2, 0), 2], 1)
+    changed = states > 0
+    return ChannelStates(on, random, array("d", frame_times[changed].tolist()),
+                         array("I", indexes[changed].tolist()),
+                         array("b", states[changed].tolist()))
+
+
+# Same as IntervalSet.active_all for a numpy array of times.
+def active_array(intervals, times):
+    numpy = load_numpy()
+    if not len(intervals):
+        return numpy.zeros(len(times), dtype=bool)
+    i = numpy.searchsorted(intervals.starts, times, side="right")
+    ends = numpy.frombuffer(intervals.ends, dtype=numpy.float64)
+    reach = numpy.where(i > 0, ends[i - 1], 0)
+    return reach - intervals.margin > times
+
+
+class FrameResolver:
+    # Works out the states of every channel a frame at a time, the same way
+    # resolve_channel works out a whole channel, so a show can be written or
+    # played without holding all of it. Only the furthest reach of the on and
+    # random intervals so far is kept for every channel.
+    def __init__(self, channels, margin=0):
+        self.channels = channels
+        self.margin = margin
+        self.on = [0] * channels
+        self.random = [0] * channels
+
+    # Takes (time, events) frames in order, with (start, channel, mode,
+    # duration, name) events and channels from 1 as in the map files, and
+    # yields (time, changes, names) for every one of them. changes are the
+    # (channel, state) changes of the frame in order of channel, with
+    # channels from 0, and names are the sections starting in it. Events on
+    # channels that aren't set up and mode 0 events change nothing.
+    def frames(self, buckets):
+        margin = self.margin
+        channels = self.channels
+        held_on = self.on
+        held_random = self.random
+        # Bit sets of the modes starting and showing on every channel the
+        # frame touches, and its longest on and random entries
+        starting = [0] * channels
+        showing = [0] * channels
+        longest_on = [0] * channels
+        longest_random = [0] * channels
+        for time, events in buckets:
+            if len(events) == 1:
+                # Most frames are a single event, which is worked out the
+                # same way as below without gathering anything first, with
+                # frame_state spelled out for one mode.
+                start, channel, mode, duration, name = events[0]
+                if mode <= 0 or not 0 < channel <= channels:
+                    yield time, [], name is not None and [name] or []
+                    continue
+                channel -= 1
+                on = held_on[channel]
+                if mode == 3 and time + duration - margin > on:
+                    on = held_on[channel] = time + duration
+                if on - margin > time:
+                    yield time, mode == 3 and [(channel, 3)] or [], []
+                    continue
+                random = held_random[channel]
+                if mode == 2 and time + duration - margin > random:
+                    random = held_random[channel] = time + duration
+                if mode == 3 and start + duration - margin > time:
+                    yield time, [(channel, 3)], []
+                elif random - margin > time:
+                    yield time, mode == 2 and [(channel, 2)] or [], []
+                elif mode == 2 and start + duration - margin > time:
+                    yield time, [(channel, 2)], []
+                else:
+                    yield time, [(channel, 1)], []
+                continue
+            names = []
+            touched = []
+            for start, channel, mode, duration, name in events:
+                if name is not None:
+                    names.append(name)
+                if mode <= 0 or not 0 < channel <= channels:
+                    continue
+                channel -= 1
+                bit = 1 << mode
+                if channel not in touched:
+                    touched.append(channel)
+                    starting[channel] = bit
+                    showing[channel] = \
+                        start + duration - margin > time and bit
+                    longest_on[channel] = mode == 3 and duration
+                    longest_random[channel] = mode == 2 and duration
+                    continue
+                starting[channel] |= bit
+                if start + duration - margin > time:
+                    showing[channel] |= bit
+                if mode == 3:
+                    if duration > longest_on[channel]:
+                        longest_on[channel] = duration
+                elif mode == 2 and duration > longest_random[channel]:
+                    longest_random[channel] = duration
+            if len(touched) > 1:
+                touched.sort()
+            changes = []
+            for channel in touched:
+                on = held_on[channel]
+                duration = longest_on[channel]
+                if duration and time + duration - margin > on:
+                    on = held_on[channel] = time + duration
+                on = on - margin > time
+                random = False
+                # Random entries only hold if nothing holds the light on.
+                if not on:
+                    random = held_random[channel]
+                    duration = longest_random[channel]
+                    if duration and time + duration - margin > random:
+                        random = held_random[channel] = time + duration
+                    random = random - margin > time
+                state = frame_state(on, random, starting[channel],
+                                    showing[channel])
+                if state:
+                    changes.append((channel, state))
+            yield time, changes, names
+
+
+class ShowStates:
+    # ChannelStates of every channel of a show, by channel from 0.
+    def __init__(self, channels):
+        self.channels = channels
+
+    def state(self, channel, time):
+        return self.channels[channel].state(time)
@@ -0,0 +1,103 @@
+"""
+Persistent song library index.
+
+Remembers the metadata of every song in a music folder along with the
+modification times it was read at. Scanning the folder again only lists it if
+the folder itself changed and only rereads song configs that changed, which
+saves a lot of time on a slow SD card.
+
+The index is usually saved into the folder it's for, and saving it changes
+the folder's modification time. So that time isn't written into the index but
+stamped on the index file as its own modification time once it's saved.
+"""
+
+from json import dump, load
+from os import fstat, listdir, replace, stat, utime
+from os.path import isdir
+
+# Bump this whenever the layout of the index or the metadata changes.
+INDEX_VERSION = 2
+
+
+class LibraryIndex:
+    def __init__(self, path):
+        self.path = path
+        self.folder = None  # Folder scanned last
+        self.folder_mtime = None
+        self.entries = {}
+        self.changed = False
+        self.errors = []  # (name, message) of songs with broken configs
+        try:
+            with open(path, "r") as data:
+                index = load(data)
+                folder_mtime = fstat(data.fileno()).st_mtime_ns
+            if index["version"] == INDEX_VERSION:
+                self.folder_mtime = folder_mtime
+                self.entries = index["entries"]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    # Returns a (name, metadata) pair for every song in folder. read is
+    # called with the song name, its folder and its config file to parse
+    # the metadata of new or changed songs, and can raise KeyError or
+    # ValueError for configs that aren't valid. Those end up in errors.
+    def scan(self, folder, extension, read):
+        self.folder = folder
+        folder_mtime = stat(folder).st_mtime_ns
+        if folder_mtime == self.folder_mtime:
+            names = list(self.entries)
+        else:
+            # Something was added or removed, so list it again.
+            names = [item for item in listdir(folder)
+                     if isdir("{}/{}".format(folder, item))]
+            self.folder_mtime = folder_mtime
+            self.changed = True
+        entries = {}
+        songs = []
+        self.errors = []
+        for name in names:
+            item_dir = "{}/{}".format(folder, name)
+            meta_file = "{}/{}.{}".format(item_dir, name, extension)
+            try:
+                config_mtime = stat(meta_file).st_mtime_ns
+            except OSError:
+                # Folders without a config are kept, so a config added to
+                # one later is still noticed without listing the folder.
+                entries[name] = {"config_mtime": None, "meta": None,
+                                 "error": None}
+                continue
+            entry = self.entries.get(name)
+            if entry is None or entry["config_mtime"] != config_mtime:
+                self.changed = True
+                entry = {"config_mtime": config_mtime, "meta": None,
+                         "error": None}
+                try:
+                    entry["meta"] = read(name, item_dir, meta_file)
+                except (KeyError, ValueError) as e:
+                    # Broken configs are remembered too and only read
+                    # again once they change.
+                    entry["error"] = "{}: {}".format(type(e).__name__, e)
+            entries[name] = entry
+            if entry["meta"] is not None:
+                songs.append((name, entry["meta"]))
+            elif entry["error"] is not None:
+                self.errors.append((name, entry["error"]))
+        if len(entries) != len(self.entries):
+            self.changed = True
+        self.entries = entries
+        return songs
+
+    def save(self):
+        if not self.changed:
+            return
+        before = stat(self.folder).st_mtime_ns
+        with open(self.path + ".tmp", "w") as out:
+            dump({"version": INDEX_VERSION, "entries": self.entries}, out)
+        replace(self.path + ".tmp", self.path)
+        # Writing the index may have changed the folder, which shouldn't make
+        # the next scan list it again. If something else changed it since it
+        # was scanned, the time it was scanned at is kept so it will.
+        if before == self.folder_mtime:
+            self.folder_mtime = stat(self.folder).st_mtime_ns
+        utime(self.path, ns=(self.folder_mtime, self.folder_mtime))
+        self.changed = False
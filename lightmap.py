@@ -0,0 +1,605 @@
+"""
+Binary lightmap format.
+
+A compiled lightmap is a small header followed by the frames and a table of
+section names. Frames only list the channels that change on them, and frames
+where nothing changes are left out, so the size of a lightmap and the work of
+playing it scale with how busy the show is rather than with the number of
+channels. Frames can be read straight out of a memory map, so playback doesn't
+have to parse anything before the music starts.
+
+Header (little endian):
+    magic       4 bytes, always b"XLM\\x00"
+    version     uint16
+    channels    uint16, number of light channels
+    frames      uint32, number of frame records
+    names       uint32, offset of the section name table
+    start       int64, time of the first frame in integer microseconds
+    keyframes   uint32, offset of the keyframe table
+
+Frame record:
+    wait        uint32, microseconds since the previous frame, or since start
+                for the first one
+    name count  uint16, number of section names starting on the frame, which
+                follow the names of the frames before it
+    flags       uint16, FLAG_ALIGN if the frame is an alignment point
+    changes     uint16, number of channels changing on the frame
+    then for each change a uint16 of the channel index in the low 14 bits and
+    its state in the top 2 bits
+
+Section name table:
+    count       uint32
+    names       uint16 byte length followed by the UTF-8 name, for each name
+
+Keyframe table, for every frame that starts sections or is an alignment point
+and at least every KEYFRAME_INTERVAL frames, so playback can start anywhere by
+reading from the keyframe before it instead of from the start:
+    count       uint32
+    then for each keyframe
+    frame       uint32, index of the frame
+    offset      uint32, offset of the frame record
+    time        int64, time of the frame in integer microseconds
+    first name  uint32, index of the first section name of the frame
+    states      2 bits per channel, four channels per byte, lowest bits first,
+                with the state of every channel right before the frame
+
+A tick timeline is the same show quantized onto a fixed grid of ticks, stored
+as a dense table with the full state of every channel on every tick. The state
+at any time is found by working out its tick instead of replaying the frames
+before it, and playing it back does the same amount of work on every tick.
+
+Tick timeline header (little endian):
+    magic       4 bytes, always b"XLT\\x00"
+    version     uint16
+    channels    uint16, number of light channels
+    ticks       uint32, number of ticks
+    rate        uint32, ticks per second
+    start       int64, time of the first tick in integer microseconds
+    marks       uint32, offset of the mark table
+
+Tick row, one after another for every tick:
+    states      4 bits per channel, two channels per byte, lowest bits first.
+                The low 2 bits are the state of the channel and TICK_SET is
+                added if the channel was set on that tick.
+
+Mark table, for every tick where sections start or that is an alignment point:
+    count       uint32
+    then for each mark a uint32 tick, uint16 flags and uint16 name count,
+    followed by the names as in the section name table
+
+Random lights (state 2) are settled from a seed in chunks ahead of the
+playhead, so the player never rolls dice while it keeps time and a show can be
+replayed exactly by reusing the seed.
+"""
+
+from bisect import bisect_right
+from itertools import islice
+from mmap import mmap, ACCESS_READ
+from os import replace
+from random import Random
+from struct import pack, Struct, unpack, unpack_from
+
+# numpy settles random lights for every frame in one go but isn't required.
+# It takes a while to import, so that only happens once it's needed.
+numpy = None
+numpy_ready = False
+
+MAGIC = b"XLM\x00"
+VERSION = 3
+FLAG_ALIGN = 1
+
+HEADER = Struct("<4sHHIIqI")
+FRAME = Struct("<IHHH")
+COUNT = Struct("<I")
+NAME = Struct("<H")
+KEYFRAME = Struct("<IIqI")
+
+# Most frames playback has to read through to get to a place in the song.
+KEYFRAME_INTERVAL = 128
+
+# A change is a channel index and a state packed into a uint16.
+STATE_SHIFT = 14
+MAX_CHANNELS = 1 << STATE_SHIFT
+MAX_WAIT = (1 << 32) - 1
+
+
+class LightmapError(Exception):
+    pass
+
+
+# Returns the numpy module, or None if it isn't installed.
+def load_numpy():
+    global numpy, numpy_ready
+    if not numpy_ready:
+        numpy_ready = True
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    return numpy
+
+
+class Frame:
+    def __init__(self, time, changes, channels, names=(), align=False):
+        self.time = time  # Absolute time in seconds
+        self.changes = changes  # Tuple of (channel, state) that change here
+        self.channels = channels  # Number of light channels
+        self.names = names  # Tuple of section names starting here
+        self.align = align  # True if this is an alignment point
+
+    # Tuple of every channel's state, with 0 for the ones that don't change.
+    @property
+    def lights(self):
+        lights = [0] * self.channels
+        for channel, state in self.changes:
+            lights[channel] = state
+        return tuple(lights)
+
+
+def pack_changes(changes):
+    return pack("<{}H".format(len(changes)),
+                *(channel | state << STATE_SHIFT
+                  for channel, state in changes))
+
+
+def unpack_changes(raw):
+    return tuple((value & MAX_CHANNELS - 1, value >> STATE_SHIFT)
+                 for value in unpack("<{}H".format(len(raw) // 2), raw))
+
+
+def pack_state(state):
+    packed = bytearray((len(state) + 3) // 4)
+    for channel, light in enumerate(state):
+        packed[channel >> 2] |= light << ((channel & 3) * 2)
+    return bytes(packed)
+
+
+def unpack_state(raw, channels):
+    return [raw[channel >> 2] >> ((channel & 3) * 2) & 3
+            for channel in range(channels)]
+
+
+def to_micros(seconds):
+    return int(round(seconds * 1000000))
+
+
+# Yields a Frame for every (time, changes, channels, names, align) record with
+# random lights settled, as off with the given probability and on otherwise.
+# Records are settled a chunk at a time as playback gets to them, so a song
+# starts right away and memory doesn't grow with its length. The same seed
+# gives the same lights again, as long as numpy is either always or never
+# installed.
+def settle(records, probability=0.5, seed=None, chunk=256):
+    numpy = load_numpy()
+    if numpy is not None:
+        rng = numpy.random.default_rng(seed)
+    else:
+        rng = Random(seed)
+    records = iter(records)
+    while True:
+        frames = list(islice(records, chunk))
+        if not frames:
+            return
+        # Dice for every random light in the chunk are rolled in one go.
+        count = sum(state == 2 for frame in frames
+                    for channel, state in frame[1])
+        if numpy is not None:
+            rolls = iter(rng.random(count).tolist())
+        else:
+            rolls = iter([rng.random() for i in range(count)])
+        for time, changes, channels, names, align in frames:
+            if count and any(state == 2 for channel, state in changes):
+                changes = tuple(
+                    (channel, state != 2 and state or
+                     (next(rolls) < probability and 1 or 3))
+                    for channel, state in changes)
+            yield Frame(time, changes, channels, names, align)
+
+
+class LightmapWriter:
+    def __init__(self, path, channels):
+        if channels > MAX_CHANNELS:
+            raise LightmapError("Lightmaps can't have more than {} "
+                                "channels.".format(MAX_CHANNELS))
+        self.path = path
+        self.channels = channels
+        self.count = 0
+        self.names = []
+        self.start = 0  # Time of the first frame written
+        self.micros = None  # Time of the last frame written
+        # What each channel was last set to. Setting a light to what it
+        # already is doesn't need writing, except for random lights, which
+        # get settled again every time.
+        self.state = [0] * channels
+        self.keyframes = []
+        # Write to a temporary file so a failed compile never leaves a
+        # truncated lightmap behind.
+        self.file = open(path + ".tmp", "wb")
+        self.file.write(bytes(HEADER.size))
+
+    # Takes the state of every channel on the frame, with 0 for no change.
+    # Frames that change nothing and start no sections are left out, the
+    # wait before the next frame covers them.
+    def write(self, time, lights, names=(), align=False):
+        changes = []
+        previous = {}
+        for channel, light in enumerate(lights):
+            if light != 0 and (light == 2 or light != self.state[channel]):
+                previous[channel] = self.state[channel]
+                changes.append((channel, light))
+                self.state[channel] = light
+        if not changes and not names and not align:
+            return
+        micros = to_micros(time)
+        if self.micros is None:
+            self.start = micros
+            self.micros = micros
+        wait = micros - self.micros
+        if not 0 <= wait <= MAX_WAIT:
+            self.file.close()
+            raise LightmapError("Frame at {} seconds is out of order or too "
+                                "long after the last one.".format(time))
+        self.micros = micros
+        if names or align or self.count % KEYFRAME_INTERVAL == 0:
+            # The state before the frame, which is the state before its
+            # changes were applied above.
+            before = list(self.state)
+            for channel, light in changes:
+                before[channel] = previous[channel]
+            self.keyframes.append(
+                KEYFRAME.pack(self.count, self.file.tell(), micros,
+                              len(self.names)) + pack_state(before))
+        self.file.write(FRAME.pack(wait, len(names),
+                                   align and FLAG_ALIGN or 0, len(changes)))
+        self.file.write(pack_changes(changes))
+        self.names.extend(names)
+        self.count += 1
+
+    def close(self):
+        names_offset = self.file.tell()
+        self.file.write(COUNT.pack(len(self.names)))
+        for name in self.names:
+            encoded = name.encode("utf-8")
+            self.file.write(NAME.pack(len(encoded)))
+            self.file.write(encoded)
+        keyframes_offset = self.file.tell()
+        self.file.write(COUNT.pack(len(self.keyframes)))
+        for keyframe in self.keyframes:
+            self.file.write(keyframe)
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, self.channels,
+                                    self.count, names_offset, self.start,
+                                    keyframes_offset))
+        self.file.close()
+        replace(self.path + ".tmp", self.path)
+
+
+class Lightmap:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise LightmapError("{} is empty.".format(path))
+        if len(self.data) < HEADER.size:
+            self.close()
+            raise LightmapError("{} is not a lightmap.".format(path))
+        magic, version = unpack_from("<4sH", self.data, 0)
+        if magic != MAGIC:
+            self.close()
+            raise LightmapError("{} is not a lightmap.".format(path))
+        elif version != VERSION:
+            self.close()
+            raise LightmapError(
+                "{} is lightmap version {}, expected {}. Recompile it.".format(
+                    path, version, VERSION))
+        magic, version, self.channels, self.count, names_offset, \
+            self.start, keyframes_offset = HEADER.unpack_from(self.data, 0)
+        self.names = []
+        offset = names_offset + COUNT.size
+        for i in range(COUNT.unpack_from(self.data, names_offset)[0]):
+            length = NAME.unpack_from(self.data, offset)[0]
+            offset += NAME.size
+            self.names.append(
+                self.data[offset:offset + length].decode("utf-8"))
+            offset += length
+        # Keyframes as (frame, offset, micros, first name, states offset),
+        # along with just their times for looking them up.
+        self.keyframes = []
+        self.keyframe_times = []
+        # Times of every section start, as (micros, name).
+        self.sections = []
+        size = KEYFRAME.size + (self.channels + 3) // 4
+        offset = keyframes_offset + COUNT.size
+        for i in range(COUNT.unpack_from(self.data, keyframes_offset)[0]):
+            frame, frame_offset, micros, first = KEYFRAME.unpack_from(
+                self.data, offset)
+            self.keyframes.append(
+                (frame, frame_offset, micros, first, offset + KEYFRAME.size))
+            self.keyframe_times.append(micros)
+            count = FRAME.unpack_from(self.data, frame_offset)[1]
+            for name in self.names[first:first + count]:
+                self.sections.append((micros, name))
+            offset += size
+        # Most frames repeat a handful of changes, so decoded changes are
+        # shared between frames.
+        self.decoded = {}
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for frame in self.records():
+            yield Frame(*frame)
+
+    # Times in seconds of every start of the named section, in order.
+    def section_times(self, name):
+        return [micros / 1000000 for micros, section in self.sections
+                if section == name]
+
+    # Yields (time, changes, channels, names, align) for every frame, with
+    # random lights left as they are. If start is given, playback starts
+    # start seconds in with a frame setting every light to what it is at that
+    # point, which is put together from the keyframe before start.
+    def records(self, start=None):
+        offset = HEADER.size
+        micros = self.start
+        first = 0
+        index = 0
+        state = None
+        if start is not None:
+            start = to_micros(start)
+            state = [0] * self.channels
+            i = bisect_right(self.keyframe_times, start) - 1
+            if i >= 0:
+                index, offset, micros, first, states = self.keyframes[i]
+                state = unpack_state(self.data[states:states + (
+                    self.channels + 3) // 4], self.channels)
+                # The frame's own wait gets added back on below.
+                micros -= FRAME.unpack_from(self.data, offset)[0]
+        for i in range(index, self.count):
+            wait, count, flags, changes = FRAME.unpack_from(self.data, offset)
+            offset += FRAME.size
+            raw = self.data[offset:offset + changes * 2]
+            offset += changes * 2
+            decoded = self.decoded.get(raw)
+            if decoded is None:
+                decoded = unpack_changes(raw)
+                self.decoded[raw] = decoded
+            micros += wait
+            names = tuple(self.names[first:first + count])
+            first += count
+            if state is not None:
+                if micros < start:
+                    for channel, light in decoded:
+                        state[channel] = light
+                    continue
+                # A frame right at the start becomes part of the first one.
+                merged = micros == start
+                if merged:
+                    for channel, light in decoded:
+                        state[channel] = light
+                yield (start / 1000000, tuple(
+                    (channel, light) for channel, light in enumerate(state)
+                    if light != 0), self.channels, merged and names or (),
+                    merged and flags & FLAG_ALIGN != 0)
+                state = None
+                if merged:
+                    continue
+            yield (micros / 1000000, decoded, self.channels, names,
+                   flags & FLAG_ALIGN != 0)
+        if state is not None:
+            # Started past the last frame.
+            yield (start / 1000000, tuple(
+                (channel, light) for channel, light in enumerate(state)
+                if light != 0), self.channels, (), False)
+
+    # Yields every frame in order with random lights settled, see settle.
+    def stream(self, probability=0.5, seed=None, chunk=256, start=None):
+        return settle(self.records(start), probability, seed, chunk)
+
+    def close(self):
+        if getattr(self, "data", None) is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+TICK_MAGIC = b"XLT\x00"
+TICK_VERSION = 1
+TICK_SET = 4
+
+TICK_HEADER = Struct("<4sHHIIqI")
+MARK = Struct("<IHH")
+
+
+# Quantizes a lightmap onto ticks of 1 / rate seconds and writes it to path.
+# Frames are moved to the nearest tick, and frames landing on the same tick
+# are merged.
+def write_ticks(lightmap, path, rate):
+    if rate <= 0:
+        raise LightmapError("Tick rate must be positive.")
+    channels = lightmap.channels
+    row_size = (channels + 1) // 2
+    state = [0] * channels
+    marks = []
+    count = 0
+    with open(path + ".tmp", "wb") as out:
+        out.write(bytes(TICK_HEADER.size))
+        start = None
+        tick = None
+        changed = set()
+        for time, changes, channels, names, align in lightmap.records():
+            micros = to_micros(time)
+            if start is None:
+                start = micros
+            frame_tick = ((micros - start) * rate + 500000) // 1000000
+            if tick is not None and frame_tick != tick:
+                # Ticks without frames just keep the state of the last one.
+                while count <= frame_tick - 1:
+                    out.write(pack_row(state, changed, row_size))
+                    changed = set()
+                    count += 1
+            tick = frame_tick
+            for channel, light in changes:
+                state[channel] = light
+                changed.add(channel)
+            if names or align:
+                if marks and marks[-1][0] == tick:
+                    marks[-1] = (tick, marks[-1][1] or align,
+                                 marks[-1][2] + names)
+                else:
+                    marks.append((tick, align, names))
+        if tick is not None:
+            out.write(pack_row(state, changed, row_size))
+            count += 1
+        marks_offset = out.tell()
+        out.write(COUNT.pack(len(marks)))
+        for tick, align, names in marks:
+            out.write(MARK.pack(tick, align and FLAG_ALIGN or 0, len(names)))
+            for name in names:
+                encoded = name.encode("utf-8")
+                out.write(NAME.pack(len(encoded)))
+                out.write(encoded)
+        out.seek(0)
+        out.write(TICK_HEADER.pack(TICK_MAGIC, TICK_VERSION, channels, count,
+                                   rate, start or 0, marks_offset))
+    replace(path + ".tmp", path)
+
+
+def pack_row(state, changed, row_size):
+    packed = bytearray(row_size)
+    for channel, light in enumerate(state):
+        if channel in changed:
+            light |= TICK_SET
+        packed[channel >> 1] |= light << ((channel & 1) * 4)
+    return bytes(packed)
+
+
+class TickTable:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise LightmapError("{} is empty.".format(path))
+        if len(self.data) < TICK_HEADER.size:
+            self.close()
+            raise LightmapError("{} is not a tick timeline.".format(path))
+        magic, version = unpack_from("<4sH", self.data, 0)
+        if magic != TICK_MAGIC:
+            self.close()
+            raise LightmapError("{} is not a tick timeline.".format(path))
+        elif version != TICK_VERSION:
+            self.close()
+            raise LightmapError(
+                "{} is tick timeline version {}, expected {}. "
+                "Recompile it.".format(path, version, TICK_VERSION))
+        magic, version, self.channels, self.count, self.rate, self.start, \
+            marks_offset = TICK_HEADER.unpack_from(self.data, 0)
+        self.row_size = (self.channels + 1) // 2
+        # Ticks where sections start or that are alignment points, in order,
+        # as (tick, names, align).
+        self.marks = []
+        offset = marks_offset + COUNT.size
+        for i in range(COUNT.unpack_from(self.data, marks_offset)[0]):
+            tick, flags, count = MARK.unpack_from(self.data, offset)
+            offset += MARK.size
+            names = []
+            for j in range(count):
+                length = NAME.unpack_from(self.data, offset)[0]
+                offset += NAME.size
+                names.append(
+                    self.data[offset:offset + length].decode("utf-8"))
+                offset += length
+            self.marks.append((tick, tuple(names), flags & FLAG_ALIGN != 0))
+        # Decoded rows are shared between ticks with the same states.
+        self.decoded = {}
+
+    def __len__(self):
+        return self.count
+
+    # Tick playing at time seconds, clamped to the ticks there are.
+    def tick(self, time):
+        tick = (to_micros(time) - self.start) * self.rate // 1000000
+        return min(max(tick, 0), self.count - 1)
+
+    def time(self, tick):
+        return self.start / 1000000 + tick / self.rate
+
+    # Returns the (states, set) of a tick: the state of every channel and the
+    # channels set on that tick.
+    def row(self, tick):
+        offset = TICK_HEADER.size + tick * self.row_size
+        raw = self.data[offset:offset + self.row_size]
+        decoded = self.decoded.get(raw)
+        if decoded is None:
+            states = []
+            changed = []
+            for channel in range(self.channels):
+                nibble = raw[channel >> 1] >> ((channel & 1) * 4) & 15
+                states.append(nibble & 3)
+                if nibble & TICK_SET:
+                    changed.append((channel, nibble & 3))
+            decoded = (tuple(states), tuple(changed))
+            self.decoded[raw] = decoded
+        return decoded
+
+    # Times in seconds of every start of the named section, in order.
+    def section_times(self, name):
+        return [self.time(tick) for tick, names, align in self.marks
+                if name in names]
+
+    # State of every channel at time seconds, with 0 for channels that
+    # haven't been set yet.
+    def state(self, time):
+        return self.row(self.tick(time))[0]
+
+    # Yields (time, changes, channels, names, align) for every tick from
+    # first on. The first one sets every channel that has a state, so
+    # playback can start on any tick.
+    def records(self, first=0):
+        marks = iter(self.marks)
+        mark = next(marks, None)
+        while mark is not None and mark[0] < first:
+            mark = next(marks, None)
+        for tick in range(first, self.count):
+            states, changes = self.row(tick)
+            if tick == first:
+                changes = tuple((channel, light) for channel, light in
+                                enumerate(states) if light != 0)
+            names = ()
+            align = False
+            if mark is not None and mark[0] == tick:
+                names = mark[1]
+                align = mark[2]
+                mark = next(marks, None)
+            yield (self.time(tick), changes, self.channels, names, align)
+
+    # Yields a frame for every tick from the one playing at start seconds on,
+    # with random lights settled, see settle.
+    def stream(self, probability=0.5, seed=None, chunk=256, start=None):
+        first = 0
+        if start is not None:
+            first = self.tick(start)
+        return settle(self.records(first), probability, seed, chunk)
+
+    def close(self):
+        if getattr(self, "data", None) is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
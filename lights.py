@@ -16,13 +16,37 @@ This year's light groupings are:
 13: The star.
 """
 
+from argparse import ArgumentParser
+from array import array
+from bisect import bisect_left
+from compilecache import CompileCache
 from configparser import ConfigParser
-from os import getcwd, listdir
-from os.path import exists, isdir
-from pygame import mixer
-from random import random
+from contextlib import redirect_stdout
+from functools import partial
+from intervals import FrameResolver, resolve_channel, \
+    resolve_channel_array, ShowStates
+from io import BytesIO, StringIO
+from json import dump
+from library import LibraryIndex
+from lightmap import LightmapError, LightmapWriter, load_numpy, TickTable, \
+    to_micros, write_ticks
+from mapfile import build_sections, MapError, parse_map
+from operator import itemgetter
+from os import getcwd, makedirs, replace
+from os.path import getsize, isdir, isfile, splitext
+import profiling
+from output import BankOutput, BoardOutput, ConsoleOutput, LogThread, \
+    NullOutput, OutputThread, PinOutput, RecorderOutput
+from random import randrange
+from scheduler import AudioSync, Scheduler
+from sectionmap import event_buckets, merge_instances, open_lightmap, \
+    SectionMapWriter
+from simulate import FakeMusic, SimClock, Simulation
 from sys import exc_info
-from time import sleep, time
+from threading import Thread
+from timing import FrameTiming
+from time import perf_counter, sleep
+from wave import Error as WaveError, open as open_wave
 
 # The compile order must have consecutive numbers from 1 to the length of the
 # tuple. e.g. (1, 4, 3, 2) is okay; (1, 2, 3, 5) is not.
@@ -33,382 +57,1041 @@ pins = (19, 13, 6, 5, 11, 9, 10, 22, 2, 3, 4, 17, 27)
 extension = "txt"  # Exclude the dot from this string.
 time_margin = 0.01
 light_probability = 0.5
+# File in the music folder that remembers what was found there last time.
+library_index = ".library.json"
+# Processes used to compile a batch of songs. None uses one per core.
+compile_workers = None
+# Random lights are settled from this seed when a song loads. Leave it as None
+# for a new seed every time, or set it to a seed printed by an earlier show to
+# get the exact same lights again.
+random_seed = None
+# Lights further off the music than this get reported at alignment points.
 lag_tolerance = 0.05
+# Fraction of the offset between the lights and the music corrected per second.
 catch_up_multiplier = 0.66
+# Offsets bigger than this many seconds are corrected in one go.
+sync_step = 0.5
+# Seconds between samples of the music position.
+sync_interval = 0.1
+# Seconds to busy wait before each frame instead of sleeping. Higher is more
+# accurate but burns more CPU.
+spin_time = 0.002
+# What to do with frames that are overdue: "skip" folds them into the next
+# frame, "compress" plays them back to back until caught up.
+late_policy = "skip"
+# Where the lights go: "gpio", "console", "null" to throw them away or
+# "record" to write every frame to record_file, with the name of the song
+# before the extension, like record.Song.csv. "auto" picks gpio if gpiozero
+# is installed and console if it isn't.
+output_backend = "auto"
+record_file = "record.csv"
+# Seconds of silence between songs in a show. 0 plays them back to back.
+show_gap = 0
+# Music of the next song in a show is read into memory while the current one
+# plays if its file is no bigger than this many megabytes, so it can be queued
+# without waiting on the disk. Bigger files and the song that starts playing
+# are streamed from disk.
+preload_music_limit = 64
+# Ticks per second of the fixed tick timeline written next to every lightmap,
+# which is played instead of the lightmap when this is set. Frames are moved
+# to the nearest tick. None doesn't write or play one.
+tick_rate = None
+# Store every section once in the lightmap along with the times it plays at,
+# and put the frames together while the song plays instead of writing every
+# one of them out. Every repeat of a section is stored as one more time it
+# plays at, so songs whose sections repeat or come up again a lot get much
+# smaller lightmaps and compile faster, but starting partway through a song
+# has to go through everything before that point.
+section_instancing = False
+# Compile and check lightmaps with numpy if it's installed. Lightmaps come out
+# the same without it, only slower.
+use_numpy = True
+# Folder a timing report is saved to after every song, as the song name with
+# .csv for every frame and .json for a summary. None doesn't record timing.
+timing_report = None
 # Testing console display variables blah blah
 test_light_color = "\033[33m\033[1m0"
 test_dim_color = "\033[0m1"
 test_endl = "\033[0m"
 
 # Everything past here doesn't need to be touched.
-# Order pins.
 ord_count = len(compile_order)
 pin_count = len(pins)
-lights = [0] * ord_count
-if ord_count < pin_count:
-    print("Some pins are unassigned orderings and won't be used.")
-elif ord_count > pin_count:
-    print("There are more orderings than pins. Cannot proceed.")
-    exit(1)
-# This system lets us keep track of pins in linear time but seems too
-# complicated for this tbh.
-for i in range(ord_count):
-    lights[compile_order[i] - 1] = pins[i]
-
-try:
-    import colorama
-
-    colorama.init()
-except ImportError:
-    colorama = None
-    print("Get colorama if you're on Windows pls.")
-# gpiozero controls the pins.
-try:
-    from gpiozero import LEDBoard
-
-    pins = LEDBoard(*pins)
-except ImportError:
-    LEDBoard = None  # Get rid of PyCharm warning.
-    pins = None
-mixer.init()
+
+# pygame, the pins, colorama and numpy all take a while to set up, so none of
+# them are touched until something actually needs them. That way compiling or
+# checking maps never waits on audio or GPIO.
+mixer = None
+board = None  # gpiozero LEDBoard driving the pins
+gpio = None  # pigpio connection, if its daemon is running
+colorama = None
+numpy = None
+pins_ready = False
+
+
+def init_audio():
+    global mixer
+    if mixer is None:
+        from pygame import mixer as pygame_mixer
+
+        pygame_mixer.init()
+        mixer = pygame_mixer
+    return mixer
+
+
+# Sets up the pins if gpiozero is installed. Returns False if the pins can't
+# be used with this setup.
+def init_pins():
+    global board, gpio, pins_ready
+    if pins_ready:
+        return True
+    # Order pins.
+    if ord_count < pin_count:
+        print("Some pins are unassigned orderings and won't be used.")
+    elif ord_count > pin_count:
+        print("There are more orderings than pins. Cannot proceed.")
+        return False
+    pins_ready = True
+    # gpiozero controls the pins.
+    try:
+        from gpiozero import LEDBoard
+
+        board = LEDBoard(*pins)
+    except ImportError:
+        return True
+    # pigpio can write every pin at once straight to the GPIO registers, but
+    # only if its daemon is running.
+    try:
+        import pigpio
+
+        gpio = pigpio.pi()
+        if not gpio.connected:
+            gpio = None
+    except ImportError:
+        pass
+    return True
+
+
+def init_console():
+    global colorama
+    if colorama is None:
+        try:
+            import colorama
+
+            colorama.init()
+        except ImportError:
+            colorama = False
+            print("Get colorama if you're on Windows pls.")
+
+
+# numpy makes compiling big maps a lot faster but isn't required.
+def init_numpy():
+    global numpy
+    numpy = None
+    if use_numpy:
+        numpy = load_numpy()
+    return numpy
+
 
 songs = []
+# Lowercase names of songs, for looking them up by prefix.
+song_names = []
 
 
-class Song:
-    def __init__(self, m_name, m_path):
-        self.name = m_name  # Name of the song
-        self.path = m_path  # Location of song folder
-        config = ConfigParser()
-        config.read("{}/{}.{}".format(m_path, m_name, extension))
+# Reads the metadata of a song from its config file.
+def read_song_meta(m_name, m_path, m_file):
+    config = ConfigParser()
+    config.read(m_file)
+    return {
         # Bool, true if compiled
-        self.compiled = config["Music"].getboolean("compiled")
+        "compiled": config["Music"].getboolean("compiled"),
         # Name of the compiled lightmap file
-        self.lights = config["Music"]["lightmap"]
+        "lights": config["Music"]["lightmap"],
         # List of the uncompiled lightmap filenames
-        self.maps = []
-        for a in config["Compile"]:
-            self.maps.append(config["Compile"][a])
+        "maps": [config["Compile"][a] for a in config["Compile"]],
         # Name of the audio file
-        self.music = config["Music"]["music"]
-        self.title = config["Music"].get("title", m_name)
-        self.volume = config["Music"].getfloat("volume", 1.0)
+        "music": config["Music"]["music"],
+        "title": config["Music"].get("title", m_name),
+        "volume": config["Music"].getfloat("volume", 1.0),
+    }
 
 
-class Entry:
-    def __init__(self, channel, mode, start, duration, name=None):
-        self.channel = channel
-        self.mode = mode
-        self.start = start
-        self.duration = duration
-        self.name = name
+class Song:
+    def __init__(self, m_name, m_path, m_meta=None):
+        self.name = m_name  # Name of the song
+        self.path = m_path  # Location of song folder
+        if m_meta is None:
+            m_meta = read_song_meta(
+                m_name, m_path, "{}/{}.{}".format(m_path, m_name, extension))
+        self.compiled = m_meta["compiled"]
+        self.lights = m_meta["lights"]
+        self.maps = list(m_meta["maps"])
+        self.music = m_meta["music"]
+        self.title = m_meta["title"]
+        self.volume = m_meta["volume"]
 
 
-class Event:
-    def __init__(self):
-        self.name = None
-        self.lights = [0] * ord_count
-        self.time = 0
-        self.align = False
+# Lays the changes of a frame over those of an earlier one. Channels both
+# frames change end up with the state from the later frame.
+def overlay(earlier, later):
+    if not earlier:
+        return later
+    merged = dict(earlier)
+    merged.update(later)
+    return tuple(merged.items())
 
 
-class Section:
-    def __init__(self, name):
-        self.bpm = 60
-        self.name = name
-        self.entries = []
-        self.repeat = 1
-        self.length = 0
-        self.times = []
+def get_song(name):
+    name = name.lower()
+    # song_names is sorted, so the first name starting with name is right
+    # where name would be inserted.
+    i = bisect_left(song_names, name)
+    if i < len(songs) and song_names[i].startswith(name):
+        return songs[i]
+    return None
 
 
-# Binary search with lambdas woo fucking hoo!
-def binary_search(array, query, key=lambda a: a):
-    if len(array) == 0:
-        return None
-    elif len(array) == 1:
-        return key(array[0]) == query and array[0] or None
-    mid = int(len(array) / 2)
-    compare_to = key(array[mid])
-    if query < compare_to:
-        return binary_search(array[:mid], query, key)
-    elif query > compare_to:
-        return binary_search(array[mid + 1:], query, key)
+# Everything that goes into expanding a section template, used as its cache
+# key. Times aren't part of it since they only place instances of the
+# template.
+def section_definition(section):
+    return (section.bpm, section.repeat, section.length,
+            [(e.channel, e.mode, e.start, e.duration) for e in
+             section.entries])
+
+
+# Event marking the start of a section in a template.
+section_marker = (0.0, 0.0, -1, -1, -1, True)
+
+
+# Expands a section into a template of (offset, extra, channel, mode,
+# duration, marker) events sorted by offset + extra, relative to one of the
+# section's times. An event starts at time + offset + extra, which is added
+# up in the same order as the times of the on and off events were before.
+# The section marker has an offset of 0 and comes before other events at 0.
+def expand_section(section):
+    template = [section_marker]
+    for i in range(section.repeat):
+        offset = section.length * i
+        for entry in section.entries:
+            start = (entry.start + offset) * 60 / section.bpm
+            duration = entry.duration * 60 / section.bpm
+            template.append(
+                (start, 0.0, entry.channel, entry.mode, duration, False))
+            template.append((start, duration, entry.channel, 1, 0, False))
+    template.sort(key=lambda a: a[0] + a[1])
+    return template
+
+
+# Expands a single repeat of a section into a template for a section map, the
+# same as expand_section but in beats and without the marker. Section maps
+# add the marker and every repeat as instances of their own, see
+# add_section_instances.
+def expand_repeat(section):
+    template = []
+    for entry in section.entries:
+        template.append((entry.start, 0.0, entry.channel, entry.mode,
+                         entry.duration, False))
+        template.append((entry.start, entry.duration, entry.channel, 1, 0,
+                         False))
+    template.sort(key=lambda a: a[0] + a[1])
+    return template
+
+
+# Layout of section templates when compiling with numpy.
+template_fields = [("offset", "f8"), ("extra", "f8"), ("channel", "i4"),
+                   ("mode", "i4"), ("duration", "f8"), ("marker", "?")]
+
+
+# Same as expand_section but builds a structured numpy array, expanding
+# repeats with broadcasting instead of one object per event.
+def expand_section_array(section):
+    entries = section.entries
+    channel = numpy.array([e.channel for e in entries], dtype="i4")
+    mode = numpy.array([e.mode for e in entries], dtype="i4")
+    start = numpy.array([e.start for e in entries], dtype="f8")
+    duration = numpy.array([e.duration for e in entries], dtype="f8")
+    offsets = section.length * numpy.arange(section.repeat)
+    start = (start[None, :] + offsets[:, None]).ravel() * 60 / section.bpm
+    duration = numpy.tile(duration, section.repeat) * 60 / section.bpm
+    channel = numpy.tile(channel, section.repeat)
+    mode = numpy.tile(mode, section.repeat)
+    # The marker is followed by an on and an off event for every entry, the
+    # same order expand_section appends them in.
+    template = numpy.zeros(1 + 2 * len(start), dtype=template_fields)
+    template[0] = section_marker
+    template["offset"][1::2] = start
+    template["offset"][2::2] = start
+    template["extra"][2::2] = duration
+    template["channel"][1::2] = channel
+    template["channel"][2::2] = channel
+    template["mode"][1::2] = mode
+    template["mode"][2::2] = 1
+    template["duration"][1::2] = duration
+    return template[numpy.argsort(template["offset"] + template["extra"],
+                                  kind="stable")]
+
+
+# Returns the (start, channel, mode, duration, name) events of one instance
+# of a section template, sorted by start. Adding time can round a start to
+# just below the one before it in the template, so the events are sorted by
+# the starts they actually get, which the merge of instances relies on. The
+# template is already nearly in order, so that's a single pass.
+def instance_events(template, time, name):
+    events = [(time + offset + extra, channel, mode, duration,
+               marker and name or None)
+              for offset, extra, channel, mode, duration, marker in template]
+    events.sort(key=itemgetter(0))
+    return events
+
+
+# Same as instance_events for a template array. Only the instance being
+# played out is turned into Python objects.
+def instance_array_events(template, time, name):
+    starts = time + template["offset"] + template["extra"]
+    if (starts[1:] < starts[:-1]).any():
+        order = numpy.argsort(starts, kind="stable")
+        starts = starts[order]
+        template = template[order]
+    return zip(
+        starts.tolist(), template["channel"].tolist(),
+        template["mode"].tolist(), template["duration"].tolist(),
+        [marker and name or None for marker in template["marker"].tolist()])
+
+
+# Adds an instance of a section template to instances for every time the
+# section plays at, for merge_instances.
+def add_instances(instances, section, template):
+    if numpy is not None:
+        first = template[["offset", "extra"]][0].tolist()
+        events = instance_array_events
     else:
-        return array[mid]
+        first = template[0][:2]
+        events = instance_events
+    for anchor in section.times:
+        instances.append((anchor + first[0] + first[1],
+                          partial(events, template, anchor, section.name)))
 
 
-def get_song(name):
-    for song in songs:
-        if song.name.lower().startswith(name):
-            return song
-    return None
+# Adds the instances of a section to a section map: the marker template at
+# every time the section plays at, followed by its template for every repeat,
+# shifted by the beats the repeat starts at. Sections without entries have no
+# template.
+def add_section_instances(writer, section, marker, template):
+    for anchor in section.times:
+        writer.add_instance(marker, section.name, anchor, section.bpm)
+        if template is None:
+            continue
+        for i in range(section.repeat):
+            writer.add_instance(template, section.name, anchor, section.bpm,
+                                section.length * i)
+
+
+# Works out the channel states of every frame and writes them out, a frame at
+# a time, so memory doesn't grow with the length of the show. The last frame
+# always turns every light off.
+def write_frames(buckets, out):
+    frame = None
+    # We completely ignore out of range light channels based on setup.
+    for cur, changes, sections in FrameResolver(
+            ord_count, time_margin).frames(buckets):
+        if frame is not None:
+            # The beginning of one or more sections entails that we want
+            # a time alignment call rather than a simple wait call.
+            out.write(frame[0], frame[1], frame[2], len(frame[2]) > 0)
+        channels = [0] * ord_count
+        for channel, state in changes:
+            channels[channel] = state
+        frame = (cur, channels, sections)
+    out.write(frame[0], [1] * ord_count)
+
+
+# Works out the ShowStates of a show from its event buckets, with every
+# channel worked out on its own from its interval sets. This holds every
+# entry of the show at once, so it's only for checking lightmaps, see
+# check_lightmap. Returns the ShowStates and the time of the last frame.
+def show_states(buckets):
+    times = array("d")
+    # Frame index, start, mode and duration of the entries of every channel
+    entries = [(array("I"), array("d"), array("b"), array("d"))
+               for i in range(ord_count)]
+    for cur, bucket in buckets:
+        index = len(times)
+        for start, channel, mode, duration, name in bucket:
+            channel -= 1
+            if -1 < channel < ord_count and mode != 0:
+                entry = entries[channel]
+                entry[0].append(index)
+                entry[1].append(start)
+                entry[2].append(mode)
+                entry[3].append(duration)
+        times.append(cur)
+    if numpy is not None:
+        resolve = resolve_channel_array
+        frame_times = numpy.frombuffer(times, dtype=numpy.float64)
+    else:
+        resolve = resolve_channel
+        frame_times = times
+    return ShowStates([resolve(frame_times, *entry, time_margin)
+                       for entry in entries]), times[-1]
+
+
+# Checks the frames of a compiled lightmap against the states its sections
+# work out to. Returns the time of the first frame a light is off from what
+# the maps say, or None if they all match.
+def check_lightmap(lightmap, sections):
+    instances = []
+    init_numpy()
+    for name in sorted(sections):
+        section = sections[name]
+        if numpy is not None:
+            add_instances(instances, section, expand_section_array(section))
+        else:
+            add_instances(instances, section, expand_section(section))
+    states, last = show_states(
+        event_buckets(merge_instances(instances), time_margin))
+    last = to_micros(last)
+    mismatch = None
+    found = set()  # (micros, channel, state) of every change in the lightmap
+    for time, changes, channels, names, align in lightmap.records():
+        micros = to_micros(time)
+        # The last frame turns everything off whatever the maps say.
+        if micros >= last:
+            break
+        # Lightmap times are rounded to the microsecond, but frames are more
+        # than a margin apart.
+        at = time + time_margin / 2
+        for channel, light in changes:
+            found.add((micros, channel, light))
+            if mismatch is None and states.state(channel, at) != light:
+                mismatch = time
+    # Changes the maps make that the lightmap doesn't have
+    for channel, resolved in enumerate(states.channels):
+        light = 0
+        for time, state in zip(resolved.times, resolved.states):
+            micros = to_micros(time)
+            if micros >= last or mismatch is not None and time >= mismatch:
+                break
+            # Lightmaps leave out setting a light to what it already is,
+            # except for random lights.
+            if state == 2 or state != light:
+                light = state
+                if (micros, channel, state) not in found:
+                    mismatch = time
+                    break
+    return mismatch
 
 
 def compile_song(song: Song):
+    with profiling.span("compile"):
+        return compile_phases(song)
+
+
+def compile_phases(song: Song):
+    span = profiling.span
     try:
         if song.lights in song.maps or song.lights == song.name:
             print("File name conflict between maps and output! Aborted.")
             return False
-        sections = []
-        events = []
+        # Loading a cache with numpy arrays in it imports numpy.
+        with span("compile/cache load"):
+            cache = CompileCache("{}/.{}.cache".format(song.path, song.name))
+        sections = {}
         for filename in song.maps:
-            bpm = 60
-            data = open("{}/{}".format(song.path, filename), "r")
-            section = None
-            for line in data:
-                line = line.split("#")[0].strip(" \r\n")
-                if not line:
-                    continue
-                # print("\"{}\"".format(line))
-                if line.lower().startswith("section:"):
-                    line = line.split(":", 1)[1].strip()
-                    section = binary_search(sections, line, lambda a: a.name)
-                    if section is None:
-                        section = Section(line)
-                        section.bpm = bpm
-                        sections.append(section)
-                        sections.sort(key=lambda a: a.name)
-                elif section is not None:
-                    if line.lower().startswith("bpm:"):
-                        bpm = float(line.split(":")[1].strip())
-                        section.bpm = bpm
-                    elif line.lower().startswith("repeat:"):
-                        line = line.split(":", 1)[1].split("b")
-                        section.repeat = int(line[0].strip())
-                        section.length = float(line[1].strip())
-                    elif line.lower().startswith("time:"):
-                        section.times.append(
-                            float(line.split(":", 1)[1].strip()))
-                    elif line.startswith("["):
-                        line = line[1:-1].split(",")
-                        channel = int(line[0].strip())
-                        mode = 3
-                        if len(line) == 4:
-                            mode = int(line[1].strip())
-                        start = float(line[-2].strip())
-                        duration = float(line[-1].strip())
-                        section.entries.append(
-                            Entry(channel, mode, start, duration))
-        for section in sections:
-            entries = []
-            for i in range(section.repeat):
-                offset = section.length * i
-                for old in section.entries:
-                    entries.append(
-                        Entry(old.channel, old.mode, old.start + offset,
-                              old.duration))
-            for time in section.times:
-                events.append(Entry(-1, -1, time, -1, section.name))
-                for entry in entries:
-                    start = time + entry.start * 60 / section.bpm
-                    duration = entry.duration * 60 / section.bpm
-                    events.append(
-                        Entry(entry.channel, entry.mode, start, duration))
-                    events.append(
-                        Entry(entry.channel, 1, start + duration, 0))
-        events.sort(key=lambda a: a.start)
-        prev = 0
-        cur = 0
-        # last = [0] * ord_count
-        channels = [0] * ord_count
-        # Fucking pass by reference instead of value cloning
-        # cutoffs = [[0, 0]] * ord_count
-        cutoffs = []
-        for i in range(ord_count):
-            cutoffs.append([0, 0])
-        sections = []
-        out = open("{}/{}".format(song.path, song.lights), "w")
-        buffer = []
-        for event in events:
-            # Dump event data if working in a new time frame.
-            if abs(event.start - cur) > time_margin:
-                for ch in channels:  # for i in range(ord_count):
-                    buffer.append(str(ch))
-                    # last[i] = ch
-                # The beginning of one or more sections entails that we want
-                # a time alignment call rather than a simple wait call.
-                if len(sections) > 0:
-                    out.write("a" + str(cur))
-                    for sec in sections:
-                        out.write("\ns" + sec)
+            with span("compile/maps"):
+                ops = cache.map_file("{}/{}".format(song.path, filename),
+                                     partial(parse_map, filename=filename))
+            with span("compile/sections"):
+                build_sections(ops, sections)
+        path = "{}/{}".format(song.path, song.lights)
+        instanced = None
+        if section_instancing:
+            instanced = SectionMapWriter(path, ord_count, time_margin)
+            marker = instanced.add_template([section_marker])
+            # Entries of a section: its template
+            shared = {}
+        instances = []
+        init_numpy()
+        for name in sorted(sections):
+            section = sections[name]
+            if instanced is not None:
+                # Templates are of a single repeat in beats, so sections that
+                # only differ in tempo or repeats share one.
+                key = repr(section_definition(section)[3])
+                if key not in shared:
+                    with span("compile/expand"):
+                        template = cache.section(
+                            section.name, ("repeat", section_definition(
+                                section)), lambda: expand_repeat(section))
+                    shared[key] = None
+                    if template:
+                        shared[key] = instanced.add_template(template)
+                add_section_instances(instanced, section, marker,
+                                      shared[key])
+                continue
+            with span("compile/expand"):
+                if numpy is not None:
+                    template = cache.section(
+                        section.name, ("array", section_definition(section)),
+                        lambda: expand_section_array(section))
                 else:
-                    out.write("w" + str(cur - prev))
-                out.write("\n")
-                out.write(",".join(buffer))
-                out.write("\n")
-                prev = cur
-                cur = event.start
-                channels = [0] * ord_count
-                buffer.clear()  # Cappycot you dumbass...
-                sections.clear()
-            if event.name is not None:
-                sections.append(event.name)
-            channel = event.channel - 1
-            # We completely ignore out of range light channels based on setup.
-            if -1 < channel < ord_count and event.mode != 0:
-                # Light on overrules everything else.
-                cutoff = cur + event.duration
-                if event.mode == 3:
-                    channels[channel] = 3
-                    if cutoff - time_margin > cutoffs[channel][1]:
-                        cutoffs[channel][1] = cutoff
-                elif cutoffs[channel][1] - time_margin <= cur:
-                    if event.mode == 2:
-                        channels[channel] = 2
-                        if cutoff - time_margin > cutoffs[channel][0]:
-                            cutoffs[channel][0] = cutoff
-                    elif cutoffs[channel][0] - time_margin <= cur:
-                        channels[channel] = 1
-        out.write("w" + str(cur - prev))
-        out.write("\n")
-        out.write(",".join(["1"] * ord_count))
-        out.flush()
-        out.close()
+                    template = cache.section(section.name,
+                                             section_definition(section),
+                                             lambda: expand_section(section))
+            # Sections go by name, so instances are listed in the same order
+            # their events used to be sorted in.
+            add_instances(instances, section, template)
+        if instanced is not None:
+            instanced.close()
+        else:
+            out = LightmapWriter(path, ord_count)
+            # Merging and bucketing happen lazily, frame by frame.
+            with span("compile/frames"):
+                write_frames(event_buckets(merge_instances(instances),
+                                           time_margin), out)
+                out.close()
+        if tick_rate is not None:
+            with span("compile/ticks"), open_lightmap(path) as lightmap:
+                write_ticks(lightmap, path + ".ticks", tick_rate)
+        with span("compile/cache save"):
+            cache.save()
         if not song.compiled:
             song.compiled = True
             song_file = "{}/{}.{}".format(song.path, song.name, extension)
             config = ConfigParser()
             config.read(song_file)
             config["Music"]["compiled"] = "true"
-            with open(song_file, "w") as song_file:
-                config.write(song_file)
+            with open(song_file + ".tmp", "w") as out:
+                config.write(out)
+            replace(song_file + ".tmp", song_file)
         return True
-    # TODO: What other errors can happen here?
-    except (FileNotFoundError, ValueError):
-        e = exc_info()
+    except MapError:
+        print("Mistake in a map file! {}".format(exc_info()[1]))
+        return False
+    except FileNotFoundError:
+        print("Couldn't find {}! Aborted.".format(exc_info()[1].filename))
+        return False
+    except (OSError, ValueError, LightmapError):
         print("Something went wrong while compiling!")
-        for a in e:
-            print(a)
+        print(exc_info()[1])
         return False
 
 
-def play_song(song: Song):
+# Compiles a song in a worker process. Returns whether it worked, how long it
+# took, whatever it printed, whether the song is compiled now and the
+# profiling spans it added up.
+def compile_worker(song: Song):
+    start = perf_counter()
+    messages = StringIO()
+    with redirect_stdout(messages):
+        try:
+            ok = compile_song(song)
+        except Exception:
+            # One broken song shouldn't take the rest of the batch down.
+            ok = False
+            print("Something went wrong while compiling!")
+            print(exc_info()[1])
+    return ok, perf_counter() - start, messages.getvalue(), song.compiled, \
+        profiling.take()
+
+
+# Settings compiling depends on that can change after this is imported, like
+# run() setting them from the command line.
+def compile_settings():
+    return ord_count, time_margin, tick_rate, section_instancing, \
+        use_numpy, profiling.enabled
+
+
+# Runs in every compile worker before it compiles anything. Workers that
+# aren't forked import this anew, so they'd only see the defaults otherwise.
+def init_compile_worker(settings):
+    global ord_count, time_margin, tick_rate, section_instancing, use_numpy
+    ord_count, time_margin, tick_rate, section_instancing, use_numpy, \
+        profile = settings
+    profiling.enable(profile)
+
+
+# Compiles every song across a pool of compile_workers processes. Returns the
+# songs that failed to compile.
+def compile_all(batch):
+    start = perf_counter()
+    failed = []
+    # Process pools take a while to import and only batches need them.
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_all_start_methods, get_context
+
+    # Forked workers start right away. Since importing this doesn't set
+    # anything up, workers started any other way work too once they're
+    # handed the settings.
+    context = None
+    if "fork" in get_all_start_methods():
+        context = get_context("fork")
+    pool = ProcessPoolExecutor(compile_workers, context, init_compile_worker,
+                               (compile_settings(),))
+    results = pool.map(compile_worker, batch)
+    busy = 0
+    for song, (ok, took, messages, compiled, spans) in zip(batch, results):
+        song.compiled = compiled
+        profiling.merge(spans)
+        busy += took
+        print("{} {} in {} seconds.".format(
+            song.name, ok and "compiled" or "failed",
+            str(int(took * 1000) / 1000)))
+        if not ok:
+            failed.append(song)
+            print(messages.rstrip())
+    pool.shutdown()
+    print("Compiled {} of {} songs in {} seconds ({} seconds of work).".format(
+        len(batch) - len(failed), len(batch),
+        str(int((perf_counter() - start) * 1000) / 1000),
+        str(int(busy * 1000) / 1000)))
+    return failed
+
+
+# Sets up the output picked by output_backend for playing song.
+def make_output(song: Song):
+    backend = output_backend
+    if backend in ("auto", "gpio"):
+        if not init_pins():
+            return None
+    if backend == "auto":
+        backend = board is None and "console" or "gpio"
+    if backend == "gpio":
+        if gpio is not None:
+            return BankOutput(gpio, pins[:ord_count], light_probability)
+        elif board is not None:
+            return BoardOutput(board, ord_count, light_probability)
+        print("gpiozero isn't installed, so there are no pins to write to.")
+        return None
+    elif backend == "console":
+        init_console()
+        return ConsoleOutput(ord_count, test_light_color, test_dim_color,
+                             test_endl, light_probability)
+    elif backend == "null":
+        return NullOutput(ord_count)
+    elif backend == "record":
+        # Every song of a show gets a file of its own.
+        root, ext = splitext(record_file)
+        return RecorderOutput(ord_count, "{}.{}{}".format(root, song.name,
+                                                           ext))
+    print("Unknown output backend {}.".format(backend))
+    return None
+
+
+class LoadedSong:
+    # A song with its lightmap open and its first frames decoded, ready to
+    # start playing right away. If preload is True and the music fits in
+    # preload_music_limit, the music is read into memory too.
+    def __init__(self, song, lightmap, seed, start=0, preload=False):
+        self.song = song
+        self.lightmap = lightmap
+        self.seed = seed
+        self.start = start  # Seconds into the song playback starts at
+        self.frames = lightmap.stream(light_probability, seed,
+                                      start=start or None)
+        self.first = next(self.frames, None)
+        self.path = "{}/{}".format(song.path, song.music)
+        self.music = None
+        # Raises FileNotFoundError if the music is missing, same as reading
+        # it would.
+        size = getsize(self.path)
+        if preload and size <= preload_music_limit * 1000000:
+            with open(self.path, "rb") as data:
+                self.music = data.read()
+        # Lets pygame tell the format without a file name.
+        self.hint = song.music.rsplit(".", 1)[-1]
+
+    # Music to hand to pygame. pygame closes music files once it's done with
+    # them, so every load needs a new one. Music that isn't in memory is
+    # streamed from its file.
+    def music_file(self):
+        if self.music is None:
+            return self.path
+        return BytesIO(self.music)
+
+    def close(self):
+        self.lightmap.close()
+
+
+# Loads a song to start playing start seconds in, or at the start of a
+# section. occurrence picks which time the section comes up, counting from 1,
+# or from the end if it's negative. preload reads the music into memory if
+# it fits, see LoadedSong.
+def load_song(song: Song, start=0, section=None, occurrence=1,
+              preload=False):
+    if song is None:
+        print("Song not found. Use 'list' to list available songs.")
+        return None
+    elif not song.compiled:
+        print("This song hasn't been compiled yet!")
+        return None
     try:
-        if song is None:
-            print("Song not found. Use 'list' to list available songs.")
-            return False
-        elif not song.compiled:
-            print("This song hasn't been compiled yet!")
-            return False
-        data = open("{}/{}".format(song.path, song.lights), "r")
-        event = Event()
-        events = []
-        print("Loading lightmap...")
-        for line in data:
-            line = line.strip(" \r\n")
-            if line == "w0":
-                continue
-            elif line.startswith("s"):
-                if event.name:
-                    event.name = "{}\n{}".format(event.name, line[1:])
-                else:
-                    event.name = line[1:]
+        if tick_rate is not None:
+            lightmap = TickTable("{}/{}.ticks".format(song.path, song.lights))
+        else:
+            lightmap = open_lightmap("{}/{}".format(song.path, song.lights))
+    except (FileNotFoundError, LightmapError):
+        print(exc_info()[1])
+        return None
+    if lightmap.channels != ord_count:
+        lightmap.close()
+        print("Lightmap has {} channels but {} are set up. "
+              "Recompile it.".format(lightmap.channels, ord_count))
+        return None
+    if tick_rate is not None and lightmap.rate != tick_rate:
+        lightmap.close()
+        print("Tick timeline has {} ticks per second but {} are set up. "
+              "Recompile it.".format(lightmap.rate, tick_rate))
+        return None
+    if section is not None:
+        times = lightmap.section_times(section)
+        if occurrence == 0 or abs(occurrence) > len(times):
+            lightmap.close()
+            print("{} doesn't have section {} {} time(s).".format(
+                song.title, section, abs(occurrence)))
+            return None
+        start = times[occurrence - 1 if occurrence > 0 else occurrence]
+    seed = random_seed
+    if seed is None:
+        seed = randrange(2 ** 32)
+    try:
+        return LoadedSong(song, lightmap, seed, start, preload)
+    except FileNotFoundError:
+        lightmap.close()
+        print(exc_info()[1])
+        return None
+
+
+class Preloader(Thread):
+    # Loads the next song of a show in the background while another plays.
+    def __init__(self, song, queue):
+        Thread.__init__(self, name="preload", daemon=True)
+        self.song = song
+        self.loaded = None
+        self.queue = queue  # True to queue its music right behind the song
+        self.queued = False  # True once its music is queued in pygame
+        self.started = False  # True once its music has started playing
+
+    def run(self):
+        with profiling.span("play/preload"):
+            self.loaded = load_song(self.song, preload=True)
+
+
+# Seconds into the music, if it was started offset seconds in, or a negative
+# number if it isn't playing.
+def music_position(music, offset=0):
+    pos = music.get_pos() / 1000
+    if pos < 0:
+        return pos
+    return offset + pos
+
+
+# Plays some music silently to get pygame going before a show starts.
+def warm_up(loaded):
+    init_audio()
+    mixer.music.load(loaded.music_file(), loaded.hint)
+    mixer.music.set_volume(0)
+    mixer.music.play()
+    sleep(0.5)
+    mixer.music.stop()
+    sleep(0.5)
+
+
+# Plays the lights of a loaded song along with its music, which has to be
+# playing already. If upcoming is a Preloader, its music is queued up to play
+# right after this song as soon as it's loaded. If simulation is a
+# Simulation, its clock, music and records are used instead of the real ones.
+# Returns False if the music failed to play.
+def perform(loaded, upcoming=None, simulation=None):
+    output = None
+    log = None
+    timing = None
+    try:
+        print("Playing {}".format(loaded.song.title))
+        print("Random lights seed: {}".format(loaded.seed))
+        if timing_report is not None or simulation is not None:
+            timing = FrameTiming()
+        if simulation is None:
+            music = mixer.music
+            sync = AudioSync(lambda: music_position(music, loaded.start),
+                             catch_up_multiplier, sync_step, sync_interval)
+            scheduler = Scheduler(spin_time, late_policy, sync)
+            lights_output = make_output(loaded.song)
+            if lights_output is None:
+                return False
+            output = OutputThread(lights_output, timing=timing)
+            log = LogThread()
+        else:
+            music = simulation.music
+            clock = simulation.clock
+            sync = AudioSync(lambda: music_position(music, loaded.start),
+                             catch_up_multiplier, sync_step, sync_interval,
+                             clock=clock, report=simulation.correct)
+            # Sleeping on the simulated clock is exact, so there's no need
+            # to spin.
+            scheduler = Scheduler(0, late_policy, sync, clock, clock.sleep)
+            lights_output = NullOutput(ord_count)
+            output = simulation
+            log = simulation
+            simulation.timing = timing
+        frames = loaded.frames
+        frame = loaded.first
+        # Changes of overdue frames that were skipped but not written yet.
+        carry = None
+        # Music position when the upcoming song was last checked on.
+        last_pos = 0
+        output.start()
+        log.start()
+        scheduler.start()
+        # The music may have been playing for a moment already.
+        scheduler.shift(-max(music_position(music, loaded.start),
+                             loaded.start))
+        lights_output.start()
+        index = None
+        while frame is not None:
+            following = next(frames, None)
+            late = scheduler.wait(frame.time)
+            if timing is not None:
+                index = timing.record(frame.time, late, sync.offset)
+            if upcoming is not None and upcoming.queue:
+                pos = music.get_pos()
+                if upcoming.queued and pos < last_pos:
+                    # The music moved on to the next song already.
+                    upcoming.started = True
+                    break
+                last_pos = pos
+                if not upcoming.queued and upcoming.loaded is not None \
+                        and music.get_busy():
+                    music.queue(upcoming.loaded.music_file(),
+                                upcoming.loaded.hint)
+                    upcoming.queued = True
+            for name in frame.names:
+                log.log(name)
+            if frame.align:
+                # Timing is corrected continuously by the AudioSync, this is
+                # just a checkpoint to report on.
+                mixpos = music_position(music, loaded.start)
+                log.log("Lightmap time: {}; pygame time: {}".format(
+                    str(int(scheduler.elapsed() * 1000) / 1000),
+                    str(int(mixpos * 1000) / 1000)))
+                if mixpos < 0 or not music.get_busy():
+                    log.log("Music failed to load or ended! Aborting...")
+                    return mixpos >= 0
+                elif abs(sync.offset) > lag_tolerance:
+                    log.log("Lights are {} seconds {} the music.".format(
+                        str(int(abs(sync.offset) * 1000) / 1000),
+                        sync.offset > 0 and "ahead of" or "behind"))
+            changes = frame.changes
+            if carry is not None:
+                changes = overlay(carry, changes)
+            frame = following
+            if following is not None and scheduler.should_skip(
+                    following.time):
+                carry = changes
                 continue
-            elif line.startswith("a"):
-                event.align = True
-                event.time = float(line[1:])
-            elif line.startswith("w"):
-                event.time = float(line[1:])
-            else:
-                instr = line.split(",")
-                for i in range(ord_count):
-                    event.lights[i] = int(instr[i])
+            # If the output can't keep up, hold on to the changes and try
+            # again with the next frame.
+            if not output.put(changes, index):
+                carry = changes
                 continue
-            events.append(event)
-            event = Event()
-        events.append(event)
-        data.close()
-        print("Loading music...")
-        mixer.music.load("{}/{}".format(song.path, song.music))
-        mixer.music.set_volume(0)
-        mixer.music.play()
-        sleep(0.5)
-        print("Playing {}".format(song.title))
-        mixer.music.stop()
-        sleep(0.5)
+            carry = None
+        if carry is not None:
+            # The last frame turns every light off, so it's waited on rather
+            # than dropped when the output is behind.
+            output.put(carry, index, wait=True)
+        output.close()
+        if isinstance(lights_output, PinOutput):
+            log.log("Pin writes took {} ms per frame on average.".format(
+                str(int(lights_output.average_cost() * 1000000) / 1000)))
+        return True
+    finally:
+        if output is not None:
+            output.close()
+        if log is not None:
+            log.close()
+        if timing_report is not None and timing is not None and \
+                timing.count > 0:
+            save_timing(loaded.song, timing)
+
+
+def save_timing(song: Song, timing):
+    makedirs(timing_report, exist_ok=True)
+    path = "{}/{}".format(timing_report, song.name)
+    timing.save(path, lag_tolerance, lag_tolerance=lag_tolerance,
+                catch_up_multiplier=catch_up_multiplier, sync_step=sync_step,
+                sync_interval=sync_interval, spin_time=spin_time,
+                late_policy=late_policy, tick_rate=tick_rate)
+    summary = timing.summary(lag_tolerance)
+    print("Frames were {} ms late at the median and {} ms at the 99th "
+          "percentile. Timing saved to {}.csv and .json.".format(
+              str(int((summary["late"]["p50"] or 0) * 1000000) / 1000),
+              str(int((summary["late"]["p99"] or 0) * 1000000) / 1000), path))
+
+
+# Plays a song, from start seconds in or from the start of a section if
+# given, see load_song.
+def play_song(song: Song, start=0, section=None, occurrence=1):
+    print("Loading {}...".format(song is None and "song" or song.title))
+    with profiling.span("play/load"):
+        loaded = load_song(song, start, section, occurrence)
+    if loaded is None:
+        return False
+    try:
+        with profiling.span("play/warm up"):
+            warm_up(loaded)
+        mixer.music.load(loaded.music_file(), loaded.hint)
         mixer.music.set_volume(song.volume)
-        last_correction = 0
-        lag_debt = 0
-        buffer = []
-        last = [" "] * ord_count
+        try:
+            mixer.music.play(start=max(loaded.start, 0))
+        # pygame raises its own error, which is a RuntimeError, if the music
+        # can't be started there.
+        except RuntimeError:
+            print("Can't start the music {} seconds in: {}".format(
+                loaded.start, exc_info()[1]))
+            return False
+        with profiling.span("play/perform"):
+            if not perform(loaded):
+                return False
+        while mixer.music.get_busy():
+            sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loaded.close()
+    mixer.music.stop()
+    return True
+
+
+# Length of a loaded song's music in seconds, if it can be told without
+# pygame, which is only for wave files.
+def music_length(loaded):
+    try:
+        with open_wave(loaded.music_file()) as music:
+            return music.getnframes() / music.getframerate()
+    except (WaveError, EOFError):
+        return None
+
+
+# Plays a song on a simulated clock with fake music, as fast as possible or
+# speed times faster than it would really take. step is passed on to the
+# SimClock, and drift, latency and granularity to the FakeMusic. Returns the
+# Simulation, with ok set to whether the song played through, or None if it
+# didn't load.
+def simulate_song(song: Song, speed=None, drift=1, latency=0,
+                  granularity=0.001, start=0, section=None, occurrence=1,
+                  step=0.000001):
+    with profiling.span("simulate/load"):
+        loaded = load_song(song, start, section, occurrence)
+    if loaded is None:
+        return None
+    try:
+        clock = SimClock(step, speed)
+        music = FakeMusic(clock, music_length(loaded), drift, latency,
+                          granularity)
+        simulation = Simulation(clock, music)
+        music.load(loaded.music_file(), loaded.hint)
+        music.play(start=max(loaded.start, 0))
+        with profiling.span("simulate/perform"):
+            simulation.ok = perform(loaded, simulation=simulation)
+    finally:
+        loaded.close()
+    return simulation
+
+
+# Simulates every song in batch and prints how each went. If report is set,
+# what happened is written there as JSON. Returns False if any song failed.
+def simulate_songs(batch, report=None, **options):
+    results = {}
+    failed = 0
+    for song in batch:
+        start = perf_counter()
+        simulation = simulate_song(song, **options)
+        took = perf_counter() - start
+        if simulation is None or not simulation.ok:
+            failed += 1
+            print("{} failed.".format(song.name))
+            if simulation is None:
+                continue
+        summary = simulation.report()
+        results[song.name] = summary
+        print("{}: {} frames over {} seconds in {} seconds ({}x), {} "
+              "corrections, largest offset {} seconds.".format(
+                  song.name, len(simulation.frames), summary["duration"],
+                  str(int(took * 1000) / 1000),
+                  int(summary["duration"] / max(took, 1e-9)),
+                  len(simulation.corrections), summary["max_offset"]))
+        for time, message in simulation.messages:
+            if message.startswith("Music failed") or \
+                    message.startswith("Lights are"):
+                print("    {}: {}".format(str(int(time * 1000) / 1000),
+                                          message))
+    if report is not None:
+        with open(report + ".tmp", "w") as out:
+            dump(results, out)
+        replace(report + ".tmp", report)
+    return failed == 0
+
+
+# Plays a list of songs back to back. While one song plays, the next one is
+# loaded in the background, and if show_gap is 0 its music is queued to start
+# the moment the current song ends.
+def play_show(show):
+    if len(show) == 0:
+        return True
+    print("Loading {}...".format(show[0].title))
+    with profiling.span("play/load"):
+        loaded = load_song(show[0])
+    if loaded is None:
+        return False
+    try:
+        with profiling.span("play/warm up"):
+            warm_up(loaded)
+        mixer.music.load(loaded.music_file(), loaded.hint)
+        mixer.music.set_volume(loaded.song.volume)
         mixer.music.play()
-        elapsed = 0
-        for event in events:
-            if event.name is not None:
-                print(event.name)
-            if pins is None:
-                for i in range(ord_count):
-                    to_append = last[i]
-                    if event.lights[i] == 1:
-                        to_append = test_dim_color
-                    elif event.lights[i] == 3:
-                        to_append = test_light_color
-                    elif event.lights[i] == 2:
-                        if random() < light_probability:
-                            to_append = test_dim_color
-                        else:
-                            to_append = test_light_color
-                    last[i] = to_append
-                    buffer.append(to_append)
-                buffer.append(test_endl)
-                print(" ".join(buffer))
-                buffer.clear()
+        for i in range(len(show)):
+            upcoming = None
+            if i + 1 < len(show):
+                upcoming = Preloader(show[i + 1], show_gap == 0)
+                upcoming.start()
+            with profiling.span("play/perform"):
+                if not perform(loaded, upcoming):
+                    return False
+            loaded.close()
+            loaded = None
+            if upcoming is None:
+                break
+            upcoming.join()
+            loaded = upcoming.loaded
+            if loaded is None:
+                print("Skipping the rest of the show.")
+                return False
+            if upcoming.queued and not upcoming.started:
+                # Catch the moment the queued music takes over.
+                last_pos = mixer.music.get_pos()
+                while mixer.music.get_busy():
+                    pos = mixer.music.get_pos()
+                    if pos < last_pos:
+                        upcoming.started = True
+                        break
+                    last_pos = pos
+                    sleep(0.001)
+            if upcoming.started:
+                mixer.music.set_volume(loaded.song.volume)
             else:
-                for i in range(ord_count):
-                    if event.lights[i] == 1:
-                        pins[i].off()
-                    elif event.lights[i] == 3:
-                        pins[i].on()
-                    elif event.lights[i] == 2:
-                        if random() < light_probability:
-                            pins[i].off()
-                        else:
-                            pins[i].on()
-            if event.align:
-                wait = event.time - elapsed - lag_debt
-                lag_debt = 0
-                if wait > 0:
-                    elapsed += wait
-                    sleep(wait)
-                mixpos = mixer.music.get_pos() / 1000
-                mark = elapsed - mixpos
-                cur = time()
-                print("Lightmap time: {}; pygame time: {}".format(
-                    str(int(elapsed * 1000) / 1000),
-                    str(int(mixpos * 1000) / 1000)))
-                if mixpos == -1 or not mixer.music.get_busy():
-                    print("Music failed to load or ended! Aborting...")
-                    return mixpos != -1
-                elif mark > 0:
-                    print("pygame music may be behind.")
-                    if cur - last_correction > 2:
-                        mark *= catch_up_multiplier
-                        sleep(mark)
-                        last_correction = cur
-                        print(
-                            "Added {} seconds to the clock.".format(str(mark)))
-                elif -mark > lag_tolerance and cur - last_correction > 2:
-                    last_correction = cur
-                    lag_debt = -mark * catch_up_multiplier
-                    print(
-                        "Shaving {} seconds off next alignment time.".format(
-                            lag_debt))
-                # elapsed = event.time
-            else:
-                elapsed += event.time
-                wait = event.time
-                if lag_debt > event.time / 2:
-                    lag_debt -= event.time / 2
-                    wait /= 2
-                elif lag_debt > 0:
-                    wait -= lag_debt
-                    lag_debt = 0
-                sleep(wait)
+                while mixer.music.get_busy():
+                    sleep(0.01)
+                sleep(show_gap)
+                mixer.music.load(loaded.music_file(), loaded.hint)
+                mixer.music.set_volume(loaded.song.volume)
+                mixer.music.play()
         while mixer.music.get_busy():
             sleep(1)
     except KeyboardInterrupt:
         pass
+    finally:
+        if loaded is not None:
+            loaded.close()
     mixer.music.stop()
     return True
 
@@ -421,25 +1104,228 @@ def scan_songs(folder=None):
         cur_dir = "{}/{}".format(getcwd(), folder)
     if not isdir(cur_dir):
         return -1
-    for item in listdir(cur_dir):
-        item_dir = "{}/{}".format(cur_dir, item)
-        # print(item)
-        if not isdir(item_dir):
-            continue
-        meta_file = "{}/{}.{}".format(item_dir, item, extension)
-        if not exists(meta_file):
-            continue
-        try:
-            # print(meta_file)
-            # This is much easier than how things were done last year.
-            songs.append(Song(item, item_dir))
-        except (KeyError, ValueError):
-            e = exc_info()
-            for a in e:
-                print(a)
+    # Songs that haven't changed since the last scan come out of the index
+    # instead of being read again.
+    index = LibraryIndex("{}/{}".format(cur_dir, library_index))
+    songs.clear()
+    for name, meta in index.scan(cur_dir, extension, read_song_meta):
+        songs.append(Song(name, "{}/{}".format(cur_dir, name), meta))
+    for name, error in index.errors:
+        print("{}: {}".format(name, error))
+    index.save()
     songs.sort(key=lambda a: a.name.lower())
+    song_names[:] = [song.name.lower() for song in songs]
+
+
+# Looks up every name, printing the ones that aren't found. No names means
+# every song.
+def find_songs(names):
+    if not names:
+        return list(songs)
+    found = []
+    for name in names:
+        song = get_song(name)
+        if song is None:
+            print("Song not found: {}".format(name))
+            return None
+        found.append(song)
+    return found
+
+
+# Checks that a song's maps parse, its music is there and its lightmap fits
+# the pins that are set up, without touching the audio or the pins. Returns a
+# list of problems.
+def validate_song(song: Song):
+    problems = []
+    if song.lights in song.maps or song.lights == song.name:
+        problems.append("File name conflict between maps and output.")
+    sections = {}
+    maps_ok = True
+    for filename in song.maps:
+        try:
+            with open("{}/{}".format(song.path, filename), "r") as data:
+                build_sections(parse_map(data.read().splitlines(), filename),
+                               sections)
+        except MapError:
+            maps_ok = False
+            problems.append(str(exc_info()[1]))
+        except OSError:
+            maps_ok = False
+            problems.append("{}: {}".format(filename, exc_info()[1]))
+    if not isfile("{}/{}".format(song.path, song.music)):
+        problems.append("Music file {} is missing.".format(song.music))
+    if song.compiled:
+        try:
+            with open_lightmap("{}/{}".format(song.path,
+                                              song.lights)) as lightmap:
+                if lightmap.channels != ord_count:
+                    problems.append(
+                        "Lightmap has {} channels but {} are set up.".format(
+                            lightmap.channels, ord_count))
+                elif maps_ok:
+                    mismatch = check_lightmap(lightmap, sections)
+                    if mismatch is not None:
+                        problems.append(
+                            "Lightmap doesn't match the maps from {} seconds "
+                            "on. Recompile it.".format(
+                                str(int(mismatch * 1000) / 1000)))
+        except (OSError, LightmapError):
+            problems.append(str(exc_info()[1]))
+    if song.compiled and tick_rate is not None:
+        try:
+            with TickTable("{}/{}.ticks".format(
+                    song.path, song.lights)) as ticks:
+                if ticks.rate != tick_rate:
+                    problems.append(
+                        "Tick timeline has {} ticks per second but {} are "
+                        "set up.".format(ticks.rate, tick_rate))
+        except (OSError, LightmapError):
+            problems.append(str(exc_info()[1]))
+    return problems
+
+
+# Times compiling each song and reading its lightmap back.
+def bench_songs(batch):
+    for song in batch:
+        start = perf_counter()
+        if not compile_song(song):
+            return False
+        took = perf_counter() - start
+        with open_lightmap("{}/{}".format(song.path, song.lights)) as lightmap:
+            start = perf_counter()
+            for frame in lightmap.stream(light_probability, random_seed):
+                pass
+            decode = perf_counter() - start
+            print("{}: compiled in {} seconds, {} frames read in {} seconds "
+                  "({} frames per second).".format(
+                      song.name, str(int(took * 1000) / 1000),
+                      len(lightmap), str(int(decode * 1000) / 1000),
+                      int(len(lightmap) / max(decode, 1e-9))))
+    return True
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Christmas light show player.")
+    parser.add_argument("--music", default="Music",
+                        help="folder with the songs, default Music")
+    parser.add_argument("--tick-rate", type=int, default=tick_rate,
+                        help="compile and play a fixed tick timeline with "
+                             "this many ticks per second")
+    parser.add_argument("--profile", action="store_true",
+                        help="print how long every phase took")
+    parser.add_argument("--cprofile",
+                        help="file to save cProfile stats of the whole run "
+                             "to")
+    commands = parser.add_subparsers(dest="command", required=True)
+    command = commands.add_parser("compile", help="compile songs")
+    command.add_argument("songs", nargs="*",
+                         help="songs to compile, default all of them")
+    command.add_argument("--instance-sections", action="store_true",
+                         default=section_instancing,
+                         help="store every section once and expand them "
+                              "while playing")
+    command = commands.add_parser("play", help="play songs one after another")
+    command.add_argument("songs", nargs="+")
+    command.add_argument("--output",
+                         choices=("auto", "gpio", "console", "null", "record"),
+                         default=output_backend)
+    command.add_argument("--seed", type=int, default=random_seed,
+                         help="seed for the random lights")
+    command.add_argument("--gap", type=float, default=show_gap,
+                         help="seconds of silence between songs")
+    command.add_argument("--at", type=float, default=0,
+                         help="seconds into the song to start at")
+    command.add_argument("--section",
+                         help="name of the section to start at")
+    command.add_argument("--occurrence", type=int, default=1,
+                         help="which time the section comes up to start at, "
+                              "negative to count from the end, default 1")
+    command.add_argument("--timing", default=timing_report,
+                         help="folder to save a timing report of every song "
+                              "to")
+    command = commands.add_parser(
+        "bench", help="time compiling songs and reading their lightmaps")
+    command.add_argument("songs", nargs="*")
+    command = commands.add_parser(
+        "simulate", help="play songs on a simulated clock with fake music")
+    command.add_argument("songs", nargs="*")
+    command.add_argument("--speed", type=float,
+                         help="times faster than real time, default as fast "
+                              "as possible")
+    command.add_argument("--drift", type=float, default=1,
+                         help="how much faster the music runs than the clock")
+    command.add_argument("--latency", type=float, default=0,
+                         help="seconds the music takes to start")
+    command.add_argument("--granularity", type=float, default=0.001,
+                         help="seconds between music position updates")
+    command.add_argument("--report", help="JSON file to write the frames, "
+                                          "corrections and messages to")
+    command.add_argument("--timing", default=timing_report,
+                         help="folder to save a timing report of every song "
+                              "to")
+    command = commands.add_parser(
+        "validate", help="check songs without playing them")
+    command.add_argument("songs", nargs="*")
+    args = parser.parse_args(argv)
+    profiling.enable(args.profile)
+    if args.cprofile is None:
+        result = run(args)
+    else:
+        from cProfile import Profile
+        from pstats import Stats
+
+        profiler = Profile()
+        result = profiler.runcall(run, args)
+        profiler.dump_stats(args.cprofile)
+        Stats(profiler).sort_stats("cumulative").print_stats(20)
+    if args.profile:
+        profiling.report()
+    return result
+
+
+def run(args):
+    global output_backend, random_seed, section_instancing, show_gap, \
+        tick_rate, timing_report
+    tick_rate = args.tick_rate
+    if scan_songs(args.music) == -1:
+        print("{} is not a folder.".format(args.music))
+        return 1
+    batch = find_songs(args.songs)
+    if batch is None:
+        return 1
+    if args.command == "compile":
+        section_instancing = args.instance_sections
+        if len(batch) == 1:
+            return not compile_song(batch[0]) and 1 or 0
+        return compile_all(batch) and 1 or 0
+    elif args.command == "play":
+        output_backend = args.output
+        random_seed = args.seed
+        show_gap = args.gap
+        timing_report = args.timing
+        if len(batch) == 1:
+            return not play_song(batch[0], args.at, args.section,
+                                 args.occurrence) and 1 or 0
+        elif args.at or args.section is not None:
+            print("Only a single song can be started partway through.")
+            return 1
+        return not play_show(batch) and 1 or 0
+    elif args.command == "bench":
+        return not bench_songs(batch) and 1 or 0
+    elif args.command == "simulate":
+        timing_report = args.timing
+        return not simulate_songs(
+            batch, args.report, speed=args.speed, drift=args.drift,
+            latency=args.latency, granularity=args.granularity) and 1 or 0
+    failed = 0
+    for song in batch:
+        problems = validate_song(song)
+        print("{}: {}".format(song.name, problems and "failed" or "ok"))
+        for problem in problems:
+            print("    " + problem)
+        failed += problems and 1 or 0
+    return failed and 1 or 0
 
 
-scan_songs("Music")
-compile_song(songs[1])
-play_song(songs[1])
+if __name__ == "__main__":
+    exit(main())
@@ -0,0 +1,173 @@
+"""
+Map file parser.
+
+A map file is read in one pass, a line at a time. Entry lines are picked out
+by their opening bracket and every other line is looked up by the keyword in
+front of its colon, so each line is only split once. Sections are kept in a
+dict by name, which lets a section be continued later in the same map file or
+in another one without searching for it.
+
+Mistakes in a map file are raised as a MapError naming the file and line they
+are on.
+"""
+
+# Map files are parsed into a list of section operations:
+# ("section", name, bpm) starts or continues a section. bpm is the tempo a
+#     new section starts with.
+# ("bpm", bpm) sets the tempo of the current section.
+# ("repeat", count, length) plays the section count times, length beats apart.
+# ("time", seconds) adds a time the section starts at.
+# ("entry", channel, mode, start, duration) adds a light entry, in beats.
+
+
+class MapError(Exception):
+    def __init__(self, filename, line, message):
+        super().__init__(filename, line, message)
+        self.filename = filename
+        self.line = line
+        self.message = message
+
+    def __str__(self):
+        return "{}:{}: {}".format(self.filename, self.line, self.message)
+
+
+class Entry:
+    def __init__(self, channel, mode, start, duration, name=None):
+        self.channel = channel
+        self.mode = mode
+        self.start = start
+        self.duration = duration
+        self.name = name
+
+
+class Section:
+    def __init__(self, name):
+        self.bpm = 60
+        self.name = name
+        self.entries = []
+        self.repeat = 1
+        self.length = 0
+        self.times = []
+
+
+# Converts text to a number with convert, raising a ValueError that says what
+# the number was meant to be if it isn't one.
+def to_number(text, convert, what):
+    try:
+        return convert(text)
+    except ValueError:
+        raise ValueError("{} should be a number, not '{}'.".format(
+            what, text.strip())) from None
+
+
+def parse_bpm(value):
+    bpm = to_number(value, float, "BPM")
+    if bpm <= 0:
+        raise ValueError("BPM has to be more than 0.")
+    return "bpm", bpm
+
+
+def parse_repeat(value):
+    count, b, length = value.partition("b")
+    if not b:
+        raise ValueError("Repeat should look like 'repeat: 4 b 8'.")
+    return "repeat", to_number(count, int, "Repeat count"), \
+        to_number(length, float, "Repeat length")
+
+
+def parse_time(value):
+    return "time", to_number(value, float, "Time")
+
+
+# "[channel, mode, start, duration]", or "[channel, start, duration]" for a
+# light that turns on.
+def parse_entry(line):
+    if line[-1] != "]":
+        raise ValueError("Entry is missing its closing ].")
+    fields = line[1:-1].split(",")
+    if len(fields) == 4:
+        mode = to_number(fields[1], int, "Mode")
+        if not 0 <= mode <= 3:
+            raise ValueError("Mode has to be 0, 1, 2 or 3, not {}.".format(
+                mode))
+    elif len(fields) == 3:
+        mode = 3
+    else:
+        raise ValueError("Entry should have 3 or 4 numbers, not {}.".format(
+            len(fields)))
+    return "entry", to_number(fields[0], int, "Channel"), mode, \
+        to_number(fields[-2], float, "Start"), \
+        to_number(fields[-1], float, "Duration")
+
+
+# Keywords that can only come up inside a section.
+section_keywords = {
+    "bpm": parse_bpm,
+    "repeat": parse_repeat,
+    "time": parse_time,
+}
+
+
+# Parses the lines of a map file into a list of section operations. Sections
+# can be continued across map files, so they are only put together once every
+# map file of a song has been parsed. Lines before the first section and
+# lines that aren't anything known are skipped.
+def parse_map(lines, filename="map"):
+    ops = []
+    bpm = 60
+    in_section = False
+    for number, line in enumerate(lines, 1):
+        comment = line.find("#")
+        if comment != -1:
+            line = line[:comment]
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            if line[0] == "[":
+                if in_section:
+                    ops.append(parse_entry(line))
+                continue
+            keyword, colon, value = line.partition(":")
+            if not colon:
+                continue
+            keyword = keyword.lower()
+            if keyword == "section":
+                name = value.strip()
+                if not name:
+                    raise ValueError("Section has no name.")
+                ops.append(("section", name, bpm))
+                in_section = True
+            elif in_section:
+                parse = section_keywords.get(keyword)
+                if parse is not None:
+                    op = parse(value)
+                    if op[0] == "bpm":
+                        bpm = op[1]
+                    ops.append(op)
+        except ValueError as e:
+            raise MapError(filename, number, str(e)) from None
+    return ops
+
+
+# Adds the section operations of a map file to sections, a dict of Sections
+# by name.
+def build_sections(ops, sections):
+    section = None
+    for op in ops:
+        kind = op[0]
+        if kind == "entry":
+            section.entries.append(Entry(op[1], op[2], op[3], op[4]))
+        elif kind == "time":
+            section.times.append(op[1])
+        elif kind == "section":
+            section = sections.get(op[1])
+            if section is None:
+                section = Section(op[1])
+                section.bpm = op[2]
+                sections[op[1]] = section
+        elif kind == "bpm":
+            section.bpm = op[1]
+        else:
+            section.repeat = op[1]
+            section.length = op[2]
@@ -31,20 +31,14 @@ except:
 from os import getcwd, listdir
 from os.path import isdir
 import pygame
-
-pygame.mixer.pre_init(frequency=44100)
-pygame.mixer.init()
-print("pygame mixer initialized. :>")
 from random import shuffle
 
 ser = None
 
 try:
     from gpiozero import LEDBoard
-
-    ser = LEDBoard(22, 10, 9, 11, 5, 6, 13, 19)
 except ImportError:
-    print("No serial package found. Test mode will be used.")
+    LEDBoard = None
 from sys import exc_info
 import time
 
@@ -441,65 +435,102 @@ def scan_songs():
 # Runner Code
 ###############################################################################
 
-print("Finishing up...")
-print(scan_songs())
-print("\033[1m\033[32mLight Player Menu:\033[31m")
-while True:
-    print(" - bluetooth [time]: sets bluetooth time delay.")
-    print(" - compile <song> : compiles/recompiles a song.")
-    print(" - play <song> : plays a song by name.")
-    print(" - playall : plays all songs in alpha order.")
-    print(" - list : lists all the available songs.")
-    print(" - rescan : gets all the songs again.")
-    print(" - serial <connect/disconnect> : connects/stops serial.")
-    print(" - shuffle : plays all songs randomly.")
-    print(" - test [song] : compiles and plays a single song.")
-    print(" - volume <0.0-1.0> : sets the playback volume.")
-    print(" - quit : exits the program.")
-    query = input("\033[0m>>> ")
-    query = query.lower()
-    result = "Command not recognized or usable..."
-
-    if query.startswith("quit"):
-        break
-    elif query.startswith("bluetooth") and query[10:]:
-        try:
-            bluetooth_delay = float(query[10:])
-            if bluetooth_delay < 0:
-                volume = 0
-            result = "Bluetooth time delay set to " + str(
-                bluetooth_delay) + " seconds."
-        except:
-            result = "Invalid time parameter."
-    elif query.startswith("bluetooth"):
-        bluetooth = not bluetooth
-        if bluetooth:
-            result = "Bluetooth time delay is on at " + str(
-                bluetooth_delay) + " seconds."
-        else:
-            result = "Bluetooth delay is off."
-    elif query.startswith("compile") and query[8:]:
-        song = get_song(query[8:])
-        if song is None:
-            result = "Song not found. Use 'list' to list available songs."
-            print("\033[2J\033[0;0H" + result)
-            print("\033[1m\033[32mLight Player Menu:\033[31m")
-            continue
-        result = compile(song)
-    elif query.startswith("list") or query.startswith("ls"):
-        result = "\033[1m\033[32mSongs:\n\033[0m" if len(
-            songs) > 0 else "There are no songs.\n"
-        for song in songs:
-            titlematch = song.name != song.title
-            if titlematch:
-                result += "\""
-            result += song.name + (
-                ("\" " + song.title) if titlematch else "") + "\n"
-        result = result[:-1]
-    elif query.startswith("play"):
-        if query == "playall":
-            result = "All songs have been played."
+# The mixer and the pins are only set up when this is run as a script, so the
+# compiler can be imported without them.
+if __name__ == "__main__":
+    pygame.mixer.pre_init(frequency=44100)
+    pygame.mixer.init()
+    print("pygame mixer initialized. :>")
+    if LEDBoard is not None:
+        ser = LEDBoard(22, 10, 9, 11, 5, 6, 13, 19)
+    else:
+        print("No serial package found. Test mode will be used.")
+    print("Finishing up...")
+    print(scan_songs())
+    print("\033[1m\033[32mLight Player Menu:\033[31m")
+    while True:
+        print(" - bluetooth [time]: sets bluetooth time delay.")
+        print(" - compile <song> : compiles/recompiles a song.")
+        print(" - play <song> : plays a song by name.")
+        print(" - playall : plays all songs in alpha order.")
+        print(" - list : lists all the available songs.")
+        print(" - rescan : gets all the songs again.")
+        print(" - serial <connect/disconnect> : connects/stops serial.")
+        print(" - shuffle : plays all songs randomly.")
+        print(" - test [song] : compiles and plays a single song.")
+        print(" - volume <0.0-1.0> : sets the playback volume.")
+        print(" - quit : exits the program.")
+        query = input("\033[0m>>> ")
+        query = query.lower()
+        result = "Command not recognized or usable..."
+
+        if query.startswith("quit"):
+            break
+        elif query.startswith("bluetooth") and query[10:]:
+            try:
+                bluetooth_delay = float(query[10:])
+                if bluetooth_delay < 0:
+                    volume = 0
+                result = "Bluetooth time delay set to " + str(
+                    bluetooth_delay) + " seconds."
+            except:
+                result = "Invalid time parameter."
+        elif query.startswith("bluetooth"):
+            bluetooth = not bluetooth
+            if bluetooth:
+                result = "Bluetooth time delay is on at " + str(
+                    bluetooth_delay) + " seconds."
+            else:
+                result = "Bluetooth delay is off."
+        elif query.startswith("compile") and query[8:]:
+            song = get_song(query[8:])
+            if song is None:
+                result = "Song not found. Use 'list' to list available songs."
+                print("\033[2J\033[0;0H" + result)
+                print("\033[1m\033[32mLight Player Menu:\033[31m")
+                continue
+            result = compile(song)
+        elif query.startswith("list") or query.startswith("ls"):
+            result = "\033[1m\033[32mSongs:\n\033[0m" if len(
+                songs) > 0 else "There are no songs.\n"
+            for song in songs:
+                titlematch = song.name != song.title
+                if titlematch:
+                    result += "\""
+                result += song.name + (
+                    ("\" " + song.title) if titlematch else "") + "\n"
+            result = result[:-1]
+        elif query.startswith("play"):
+            if query == "playall":
+                result = "All songs have been played."
+                for song in songs:
+                    if song.name.lower() != test_song.lower():
+                        try:
+                            play(song, chain=True)
+                        except:
+                            try:
+                                print(
+                                    "\nSkipping... Tap Ctrl+C again within 1 sec to abort all playback.")
+                                time.sleep(1)
+                            except:
+                                result = "Playback aborted."
+                                break
+            else:
+                query = query.split(" ")
+                if len(query) > 1:
+                    query = query[1].strip()
+                    result = play(get_song(query))
+                else:
+                    result = "Specify a song to play. Use 'list' to list the songs."
+        elif query == "shuffle":
+            shuffled = []
             for song in songs:
+                if song.name.lower() != test_song.lower():
+                    shuffled.append(song)
+            result = "All songs have been played randomly."
+            shuffle(shuffled)
+
+            for song in shuffled:
                 if song.name.lower() != test_song.lower():
                     try:
                         play(song, chain=True)
@@ -511,76 +542,49 @@ while True:
                         except:
                             result = "Playback aborted."
                             break
-        else:
-            query = query.split(" ")
-            if len(query) > 1:
-                query = query[1].strip()
-                result = play(get_song(query))
+        elif query.startswith("rescan") or query.startswith("scan"):
+            result = scan_songs()
+        elif query == "serial connect":
+            pass
+        elif query == "serial disconnect":
+            pass
+        elif query.startswith("serial"):
+            result = "Serial is " + ("not " if ser is None else "") + "connected."
+        elif query.startswith("test"):
+            song = None
+            if query[5:]:
+                song = get_song(query[5:])
             else:
-                result = "Specify a song to play. Use 'list' to list the songs."
-    elif query == "shuffle":
-        shuffled = []
-        for song in songs:
-            if song.name.lower() != test_song.lower():
-                shuffled.append(song)
-        result = "All songs have been played randomly."
-        shuffle(shuffled)
-
-        for song in shuffled:
-            if song.name.lower() != test_song.lower():
-                try:
-                    play(song, chain=True)
-                except:
-                    try:
-                        print(
-                            "\nSkipping... Tap Ctrl+C again within 1 sec to abort all playback.")
-                        time.sleep(1)
-                    except:
-                        result = "Playback aborted."
-                        break
-    elif query.startswith("rescan") or query.startswith("scan"):
-        result = scan_songs()
-    elif query == "serial connect":
-        pass
-    elif query == "serial disconnect":
-        pass
-    elif query.startswith("serial"):
-        result = "Serial is " + ("not " if ser is None else "") + "connected."
-    elif query.startswith("test"):
-        song = None
-        if query[5:]:
-            song = get_song(query[5:])
-        else:
-            song = get_song(test_song)
-        if song is None:
-            result = "Song not found. Use 'list' to list available songs."
-            print("\033[2J\033[0;0H" + result)
-            print("\033[1m\033[32mLight Player Menu:\033[31m")
-            continue
-        try:
-            print(compile(song, chain=True))
-        except:
-            result = "Compile failed! (Run \"compile " + song.name + "\" for more info.)"
-            print("\033[2J\033[0;0H" + result)
-            print("\033[1m\033[32mLight Player Menu:\033[31m")
-            continue
-        try:
-            play(song, chain=True)
-            result = "Song tested."
-        except:
-            result = "Song either aborted or something went wrong..."
-    elif query.startswith("volume"):
-        try:
-            volume = float(query[7:])
-            if volume > 1:
-                while volume > 100:
-                    volume /= 10
-                volume /= 100
-            elif volume < 0:
-                volume = 0
-            result = "Volume set to " + str(volume) + "."
-        except:
-            result = "Invalid volume parameter."
-
-    print("\033[2J\033[0;0H" + result)
-    print("\033[1m\033[32mLight Player Menu:\033[31m")
+                song = get_song(test_song)
+            if song is None:
+                result = "Song not found. Use 'list' to list available songs."
+                print("\033[2J\033[0;0H" + result)
+                print("\033[1m\033[32mLight Player Menu:\033[31m")
+                continue
+            try:
+                print(compile(song, chain=True))
+            except:
+                result = "Compile failed! (Run \"compile " + song.name + "\" for more info.)"
+                print("\033[2J\033[0;0H" + result)
+                print("\033[1m\033[32mLight Player Menu:\033[31m")
+                continue
+            try:
+                play(song, chain=True)
+                result = "Song tested."
+            except:
+                result = "Song either aborted or something went wrong..."
+        elif query.startswith("volume"):
+            try:
+                volume = float(query[7:])
+                if volume > 1:
+                    while volume > 100:
+                        volume /= 10
+                    volume /= 100
+                elif volume < 0:
+                    volume = 0
+                result = "Volume set to " + str(volume) + "."
+            except:
+                result = "Invalid volume parameter."
+
+        print("\033[2J\033[0;0H" + result)
+        print("\033[1m\033[32mLight Player Menu:\033[31m")
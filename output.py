@@ -0,0 +1,278 @@
+"""
+Light output and console logging off the timing thread.
+
+The player only decides when a frame is due. Writing the lights happens on an
+OutputThread fed through a FrameRing, and everything printed during playback
+goes through a LogThread, so a slow terminal or SSH session can't hold up the
+timing of the lights.
+
+Outputs are what the lights get written to: GPIO pins, the console, nothing at
+all for benchmarking, or a file recording every frame. Every frame comes in as
+the (channel, state) pairs of the channels that change on it. Pin outputs
+remember what they last wrote and only touch the hardware for channels that
+actually changed, in a single update per frame.
+"""
+
+from queue import SimpleQueue
+from random import random
+from threading import Event, Thread
+from time import perf_counter, sleep
+
+
+class FrameRing:
+    # Bounded ring buffer for exactly one producer and one consumer. Only the
+    # producer moves tail and only the consumer moves head, so the data path
+    # needs no lock. The event is only used to wake up the consumer.
+    def __init__(self, size):
+        self.slots = [None] * (size + 1)
+        self.head = 0  # Next slot to read
+        self.tail = 0  # Next slot to write
+        self.ready = Event()
+
+    # Returns False without blocking if the ring is full.
+    def put(self, item):
+        tail = (self.tail + 1) % len(self.slots)
+        if tail == self.head:
+            return False
+        self.slots[self.tail] = item
+        self.tail = tail
+        self.ready.set()
+        return True
+
+    def get(self):
+        while self.head == self.tail:
+            self.ready.clear()
+            # Check again in case a put came in before the clear.
+            if self.head != self.tail:
+                break
+            self.ready.wait()
+        item = self.slots[self.head]
+        self.slots[self.head] = None
+        self.head = (self.head + 1) % len(self.slots)
+        return item
+
+
+class OutputThread(Thread):
+    # Writes every frame of changes put into the ring to an Output. If timing
+    # is a FrameTiming, how long every write takes is recorded in it.
+    def __init__(self, output, size=16, timing=None):
+        Thread.__init__(self, name="output", daemon=True)
+        self.output = output
+        self.timing = timing
+        self.ring = FrameRing(size)
+
+    # Returns False if the output is falling behind and the frame was not
+    # queued. With wait, waits for room instead, for frames that can't be
+    # dropped, unless the thread isn't running. index is the frame's index
+    # in the timing records, if any.
+    def put(self, changes, index=None, wait=False):
+        while not self.ring.put((changes, index)):
+            if not wait or not self.is_alive():
+                return False
+            sleep(0.001)
+        return True
+
+    def run(self):
+        while True:
+            item = self.ring.get()
+            if item is None:
+                return
+            changes, index = item
+            if self.timing is None or index is None:
+                self.output(changes)
+            else:
+                start = perf_counter()
+                self.output(changes)
+                self.timing.wrote(index, perf_counter() - start)
+
+    # Writes out whatever is still queued, stops the thread and closes the
+    # output.
+    def close(self):
+        if self.is_alive():
+            while not self.ring.put(None):
+                sleep(0.001)
+            self.join()
+        self.output.close()
+
+
+class LogThread(Thread):
+    # Prints messages in the background so printing never blocks the caller.
+    def __init__(self):
+        Thread.__init__(self, name="log", daemon=True)
+        self.queue = SimpleQueue()
+
+    def log(self, message):
+        self.queue.put(message)
+
+    def run(self):
+        while True:
+            message = self.queue.get()
+            if message is None:
+                return
+            print(message)
+
+    def close(self):
+        if not self.is_alive():
+            return
+        self.queue.put(None)
+        self.join()
+
+
+class Output:
+    # Base for everything the lights can be written to. An output is called
+    # with the (channel, state) changes of every frame, from the output
+    # thread.
+    def __init__(self, channels):
+        self.channels = channels
+        self.frames = 0  # Frames written so far
+
+    # Called right as playback starts.
+    def start(self):
+        pass
+
+    def __call__(self, changes):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class NullOutput(Output):
+    # Throws the lights away, for timing the player without any output cost.
+    def __call__(self, changes):
+        self.frames += 1
+
+
+class ConsoleOutput(Output):
+    # Prints a row of lights to the console for every frame.
+    def __init__(self, channels, on, off, end, probability=0.5):
+        Output.__init__(self, channels)
+        self.on = on  # How a light that's on is shown
+        self.off = off  # How a light that's off is shown
+        self.end = end  # Printed after every row
+        self.probability = probability  # Chance of a random light being off
+        self.last = [" "] * channels  # What each light was last shown as
+
+    def __call__(self, changes):
+        for channel, state in changes:
+            if state == 1:
+                self.last[channel] = self.off
+            elif state == 3:
+                self.last[channel] = self.on
+            elif state == 2:
+                if random() < self.probability:
+                    self.last[channel] = self.off
+                else:
+                    self.last[channel] = self.on
+        print(" ".join(self.last + [self.end]))
+        self.frames += 1
+
+
+class RecorderOutput(Output):
+    # Records every frame to a CSV file as the seconds since playback
+    # started followed by the state of every channel, 0 for the ones that
+    # didn't change, for comparing against the lightmap.
+    def __init__(self, channels, path, clock=perf_counter):
+        Output.__init__(self, channels)
+        self.clock = clock
+        self.origin = None
+        self.file = open(path, "w")
+
+    def start(self):
+        self.origin = self.clock()
+
+    def __call__(self, changes):
+        now = self.clock()
+        if self.origin is None:
+            self.origin = now
+        lights = [0] * self.channels
+        for channel, state in changes:
+            lights[channel] = state
+        self.file.write("{:.6f},{}\n".format(
+            now - self.origin, ",".join(str(light) for light in lights)))
+        self.frames += 1
+
+    def close(self):
+        self.file.close()
+
+
+class PinOutput(Output):
+    # Base for pin outputs. Works out which pins a frame turns on or off,
+    # hands the changes to update and keeps track of how long writes take.
+    def __init__(self, channels, probability=0.5):
+        Output.__init__(self, channels)
+        self.probability = probability  # Chance of a random light being off
+        self.state = None  # What each pin was last set to, if known
+        self.cost = 0  # Seconds the last frame took to write
+        self.total_cost = 0
+        self.writes = 0  # Frames that actually changed a pin
+
+    def __call__(self, changes):
+        start = perf_counter()
+        state = self.state
+        if state is None:
+            state = [False] * self.channels
+            changed = list(range(self.channels))
+        else:
+            state = list(state)
+            changed = []
+        for channel, light in changes:
+            on = light == 3 or light == 2 and random() >= self.probability
+            if on != state[channel]:
+                state[channel] = on
+                if self.state is not None:
+                    changed.append(channel)
+        if changed:
+            self.update(state, changed)
+            self.state = state
+            self.writes += 1
+        self.cost = perf_counter() - start
+        self.total_cost += self.cost
+        self.frames += 1
+
+    def update(self, state, changed):
+        raise NotImplementedError
+
+    def average_cost(self):
+        return self.writes and self.total_cost / self.writes or 0
+
+
+class BoardOutput(PinOutput):
+    # Sets every pin of a gpiozero LEDBoard with one value assignment.
+    def __init__(self, board, channels, probability=0.5):
+        PinOutput.__init__(self, channels, probability)
+        self.board = board
+
+    def close(self):
+        self.board.off()
+
+    def update(self, state, changed):
+        self.board.value = tuple(state) + (False,) * (
+            len(self.board) - self.channels)
+
+
+class BankOutput(PinOutput):
+    # Sets and clears pins straight in the GPIO registers through pigpio,
+    # with one call for the pins turning on and one for those turning off.
+    def __init__(self, gpio, numbers, probability=0.5):
+        PinOutput.__init__(self, len(numbers), probability)
+        self.gpio = gpio
+        self.masks = [1 << number for number in numbers]
+        for number in numbers:
+            gpio.set_mode(number, 1)  # pigpio.OUTPUT
+
+    def close(self):
+        self.gpio.clear_bank_1(sum(self.masks))
+
+    def update(self, state, changed):
+        on = 0
+        off = 0
+        for i in changed:
+            if state[i]:
+                on |= self.masks[i]
+            else:
+                off |= self.masks[i]
+        if on:
+            self.gpio.set_bank_1(on)
+        if off:
+            self.gpio.clear_bank_1(off)
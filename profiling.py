@@ -0,0 +1,74 @@
+"""
+Opt-in profiling spans.
+
+The phases of compiling and playing a song are wrapped in named spans. Unless
+profiling is turned on, a span is a shared context manager that does nothing,
+so they can stay in the code for good. With profiling on, the time spent in
+every span is added up by name and can be printed after a run.
+"""
+
+from contextlib import nullcontext
+from time import perf_counter
+
+enabled = False
+spans = {}  # name: [times entered, total seconds]
+NULL_SPAN = nullcontext()
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.start = 0
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        add(self.name, 1, perf_counter() - self.start)
+
+
+def span(name):
+    if not enabled:
+        return NULL_SPAN
+    return Span(name)
+
+
+def enable(on=True):
+    global enabled
+    enabled = on
+
+
+def add(name, count, seconds):
+    total = spans.get(name)
+    if total is None:
+        spans[name] = [count, seconds]
+    else:
+        total[0] += count
+        total[1] += seconds
+
+
+# Returns the spans added up so far and starts over, for handing them back
+# from a worker process.
+def take():
+    taken = dict(spans)
+    spans.clear()
+    return taken
+
+
+def merge(other):
+    for name, (count, seconds) in other.items():
+        add(name, count, seconds)
+
+
+def report():
+    if not spans:
+        print("Nothing was profiled.")
+        return
+    width = max(len(name) for name in spans)
+    print("{}  {:>7}  {:>10}  {:>10}".format(
+        "phase".ljust(width), "count", "total ms", "each ms"))
+    for name in sorted(spans):
+        count, seconds = spans[name]
+        print("{}  {:>7}  {:>10.3f}  {:>10.3f}".format(
+            name.ljust(width), count, seconds * 1000, seconds * 1000 / count))
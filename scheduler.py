@@ -0,0 +1,156 @@
+"""
+Absolute deadline frame scheduler.
+
+Frames are released at fixed offsets from the moment playback started instead
+of by sleeping for the gap between frames, so oversleeping, console printing
+and pin writes can't add up to drift. Waiting sleeps most of the way and spins
+for the last bit, since sleep on its own is only good to a few milliseconds.
+
+AudioSync keeps those offsets lined up with the music. It fits a line through
+recent music positions, runs the schedule at the slope of that line so a clock
+that runs a little fast or slow compared to the music doesn't leave the lights
+lagging behind, and nudges the schedule towards the line a little at a time,
+so corrections are spread out instead of applied in jumps.
+"""
+
+from collections import deque
+from time import perf_counter, sleep
+
+# What to do with frames that are already overdue when they come up.
+COMPRESS = "compress"  # Release them right away, one after another.
+SKIP = "skip"  # Fold them into the next frame and only write the latest.
+LATE_POLICIES = (COMPRESS, SKIP)
+
+
+class Scheduler:
+    def __init__(self, spin=0.002, policy=COMPRESS, sync=None,
+                 clock=perf_counter, sleep=sleep):
+        if policy not in LATE_POLICIES:
+            raise ValueError("Unknown late policy {}.".format(policy))
+        self.spin = spin  # Seconds to busy wait before a deadline
+        self.policy = policy
+        self.sync = sync  # AudioSync to keep the schedule on the music
+        self.clock = clock
+        self.sleep = sleep
+        self.origin = 0  # Clock reading at time 0 of the lightmap
+        self.rate = 1  # Seconds of lightmap per second of the clock
+
+    def start(self):
+        self.origin = self.clock()
+
+    # Moves every following deadline back (positive) or forward (negative)
+    # by seconds of lightmap.
+    def shift(self, seconds):
+        self.origin += seconds / self.rate
+
+    # Changes how fast the lightmap runs from now on, keeping the position
+    # at now where it is.
+    def set_rate(self, rate, now):
+        self.origin = now - (now - self.origin) * self.rate / rate
+        self.rate = rate
+
+    # Position on the lightmap timeline at clock reading now.
+    def position(self, now):
+        return (now - self.origin) * self.rate
+
+    # Clock reading the lightmap reaches target seconds at.
+    def deadline(self, target):
+        return self.origin + target / self.rate
+
+    # Current position on the lightmap timeline.
+    def elapsed(self):
+        return self.position(self.clock())
+
+    def due(self, target):
+        return self.clock() >= self.deadline(target)
+
+    # Waits until the lightmap reaches target seconds and returns how late
+    # that happened, which is never less than 0.
+    def wait(self, target):
+        if self.sync is None:
+            remaining = self.deadline(target) - self.clock()
+            if remaining > self.spin:
+                self.sleep(remaining - self.spin)
+        else:
+            # Long waits are split up so the music keeps getting sampled
+            # and the deadline can move while we sleep.
+            self.sync.update(self)
+            remaining = self.deadline(target) - self.clock()
+            while remaining > self.spin:
+                self.sleep(min(remaining - self.spin, self.sync.interval))
+                self.sync.update(self)
+                remaining = self.deadline(target) - self.clock()
+        deadline = self.deadline(target)
+        now = self.clock()
+        while now < deadline:
+            now = self.clock()
+        return now - deadline
+
+    # True if the current frame can be folded into the one after it, which is
+    # due at following seconds.
+    def should_skip(self, following):
+        return self.policy == SKIP and self.due(following)
+
+
+class AudioSync:
+    def __init__(self, position, gain=0.66, step=0.5, interval=0.1,
+                 window=30, drift=0.05, clock=perf_counter, report=None):
+        # Callable returning how far the music is in seconds, or a negative
+        # number if it isn't playing.
+        self.position = position
+        self.gain = gain  # Fraction of the offset to correct per second
+        self.step = step  # Offsets bigger than this are corrected at once
+        self.interval = interval  # Seconds between music position samples
+        # Most the music is trusted to run faster or slower than the clock,
+        # as a fraction of normal speed.
+        self.drift = drift
+        self.clock = clock
+        # Called with the offset and the shift of every correction made.
+        self.report = report
+        self.samples = deque(maxlen=window)
+        self.last = None  # Clock reading of the last sample
+        self.offset = 0  # How far the lights are ahead of the music
+
+    # Music position at now and seconds of music per second of the clock,
+    # from a least squares line through the samples.
+    def estimate(self, now):
+        count = len(self.samples)
+        mean_time = sum(s[0] for s in self.samples) / count
+        mean_pos = sum(s[1] for s in self.samples) / count
+        spread = sum((s[0] - mean_time) ** 2 for s in self.samples)
+        slope = 1
+        if spread > 0:
+            slope = sum((s[0] - mean_time) * (s[1] - mean_pos)
+                        for s in self.samples) / spread
+            # Sound cards are only ever a little off, so keep a bad fit from
+            # running off.
+            slope = min(max(slope, 1 - self.drift), 1 + self.drift)
+        return mean_pos + slope * (now - mean_time), slope
+
+    def update(self, scheduler):
+        now = self.clock()
+        if self.last is not None and now - self.last < self.interval:
+            return
+        position = self.position()
+        # The music position is read in between two clock readings.
+        now = (now + self.clock()) / 2
+        passed = 0 if self.last is None else now - self.last
+        self.last = now
+        # Nothing to line up with until the music is actually playing.
+        if position <= 0:
+            return
+        self.samples.append((now, position))
+        if len(self.samples) < 3:
+            return
+        position, slope = self.estimate(now)
+        # The schedule runs as fast as the music does, which leaves only
+        # whatever offset it had to be nudged away.
+        scheduler.set_rate(slope, now)
+        self.offset = scheduler.position(now) - position
+        if abs(self.offset) > self.step:
+            shift = self.offset
+        else:
+            shift = self.offset * min(1, self.gain * passed)
+        scheduler.shift(shift)
+        if self.report is not None:
+            self.report(self.offset, shift)
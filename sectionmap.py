@@ -0,0 +1,332 @@
+"""
+Section instanced lightmaps.
+
+Instead of writing out every frame of a song, a section map stores the
+expanded events of a single repeat of every section once, as a template in
+beats relative to the start of the section, along with the times, tempos and
+beats into the section every repeat plays at. The start of a section is an
+instance of a template holding just the event that marks it. Beats are turned
+into seconds the same way compiling a lightmap does, so both give the same
+frames, and sections that only differ in tempo or repeats share a template.
+The frames are put
+together while the song plays: instances are only expanded once playback gets
+to them, merged into one stream of events and worked out a frame at a time,
+so the size of a section map and the work of compiling it scale with the
+unique content of a song rather than with its length.
+
+Header (little endian):
+    magic       4 bytes, always b"XLS\\x00"
+    version     uint16
+    channels    uint16, number of light channels
+    templates   uint32, number of templates
+    instances   uint32, number of instances
+    names       uint32, offset of the section name table
+    margin      float64, seconds within which events make up one frame
+
+Template, one after another from right after the header:
+    count       uint32, number of events
+    then for each event, in the order they start in
+    offset      float64, beats after the start of the repeat
+    extra       float64, beats after offset, for events that end entries
+    channel     int32, light channel from 1 as in the map files, or -1 for
+                the event marking the start of the section
+    mode        int32, mode of the entry, or -1 for the section start
+    duration    float64, beats the entry lasts
+    marker      uint8, 1 for the event marking the start of the section
+
+Instance table, right after the templates, in the order ties between
+instances go in:
+    template    uint32, index of the template
+    name        uint32, index of the section name
+    time        float64, seconds into the song the section starts at
+    shift       float64, beats from the start of the section to the repeat
+    bpm         float64, tempo the beats are turned into seconds with
+
+Section name table, the same as in a lightmap.
+
+A section map is opened with open_lightmap, which tells it apart from a
+lightmap, and played the same way.
+"""
+
+from functools import partial
+from heapq import heappop, heappush
+from intervals import FrameResolver
+from lightmap import COUNT, Frame, Lightmap, LightmapError, MAX_CHANNELS, \
+    NAME, settle, to_micros
+from mmap import mmap, ACCESS_READ
+from operator import itemgetter
+from os import replace
+from struct import Struct, unpack_from
+
+SECTION_MAGIC = b"XLS\x00"
+SECTION_VERSION = 2
+
+SECTION_HEADER = Struct("<4sHHIIId")
+EVENT = Struct("<ddiid?")
+INSTANCE = Struct("<IIddd")
+
+
+# Merges section instances into one sorted event stream. Each instance is a
+# (first, events) pair, where first is the time of its first event and
+# events is a callable returning its events in order. Instances are only
+# started once the merge reaches them, so memory depends on how many
+# instances overlap rather than on the length of the song. Ties go to the
+# instance listed first, same as a stable sort would.
+def merge_instances(instances):
+    order = sorted(range(len(instances)), key=lambda a: instances[a][0])
+    heap = []
+    i = 0
+    while heap or i < len(order):
+        while i < len(order) and (
+                not heap or instances[order[i]][0] <= heap[0][0]):
+            events = iter(instances[order[i]][1]())
+            for event in events:
+                heappush(heap, (event[0], order[i], event, events))
+                break
+            i += 1
+        start, index, event, events = heappop(heap)
+        yield event
+        for event in events:
+            heappush(heap, (event[0], index, event, events))
+            break
+
+
+# Groups a sorted event stream into (time, events) frames. Events within
+# margin of the first event of a frame belong to that frame.
+def event_buckets(events, margin):
+    cur = 0
+    bucket = []
+    for event in events:
+        if abs(event[0] - cur) > margin:
+            yield cur, bucket
+            cur = event[0]
+            bucket = []
+        bucket.append(event)
+    yield cur, bucket
+
+
+# Returns the (start, channel, mode, duration, name) events of one instance
+# of a section template, given as (offset, extra, channel, mode, duration,
+# marker) events in beats, sorted by start the same way instance_events in
+# lights does. Seconds are worked out in the same order as expand_section in
+# lights does, so starts come out exactly the same.
+def beat_events(template, time, shift, bpm, name):
+    events = [(time + (offset + shift) * 60 / bpm + extra * 60 / bpm, channel,
+               mode, duration * 60 / bpm, marker and name or None)
+              for offset, extra, channel, mode, duration, marker in template]
+    events.sort(key=itemgetter(0))
+    return events
+
+
+class SectionMapWriter:
+    def __init__(self, path, channels, margin):
+        if channels > MAX_CHANNELS:
+            raise LightmapError("Lightmaps can't have more than {} "
+                                "channels.".format(MAX_CHANNELS))
+        self.path = path
+        self.channels = channels
+        self.margin = margin
+        self.templates = 0
+        self.instances = []
+        self.names = {}  # Name: index in the name table
+        self.file = open(path + ".tmp", "wb")
+        self.file.write(bytes(SECTION_HEADER.size))
+
+    # Writes a template of (offset, extra, channel, mode, duration, marker)
+    # events, either a list or a numpy array laid out the same way, and
+    # returns its index.
+    def add_template(self, template):
+        self.file.write(COUNT.pack(len(template)))
+        if hasattr(template, "tobytes"):
+            self.file.write(template.tobytes())
+        else:
+            for event in template:
+                self.file.write(EVENT.pack(*event))
+        self.templates += 1
+        return self.templates - 1
+
+    def add_instance(self, template, name, time, bpm, shift=0.0):
+        index = self.names.setdefault(name, len(self.names))
+        self.instances.append(INSTANCE.pack(template, index, time, shift,
+                                            bpm))
+
+    def close(self):
+        self.file.write(b"".join(self.instances))
+        names_offset = self.file.tell()
+        self.file.write(COUNT.pack(len(self.names)))
+        for name in self.names:
+            encoded = name.encode("utf-8")
+            self.file.write(NAME.pack(len(encoded)))
+            self.file.write(encoded)
+        self.file.seek(0)
+        self.file.write(SECTION_HEADER.pack(
+            SECTION_MAGIC, SECTION_VERSION, self.channels, self.templates,
+            len(self.instances), names_offset, self.margin))
+        self.file.close()
+        replace(self.path + ".tmp", self.path)
+
+
+class SectionMap:
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            self.data = mmap(self.file.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            self.file.close()
+            raise LightmapError("{} is empty.".format(path))
+        if len(self.data) < SECTION_HEADER.size or \
+                self.data[:4] != SECTION_MAGIC:
+            self.close()
+            raise LightmapError("{} is not a section map.".format(path))
+        version = unpack_from("<H", self.data, 4)[0]
+        if version != SECTION_VERSION:
+            self.close()
+            raise LightmapError(
+                "{} is section map version {}, expected {}. "
+                "Recompile it.".format(path, version, SECTION_VERSION))
+        magic, version, self.channels, templates, instances, names_offset, \
+            self.margin = SECTION_HEADER.unpack_from(self.data, 0)
+        # Offset and event count of every template, which are only read once
+        # playback gets to an instance of them.
+        self.templates = []
+        offset = SECTION_HEADER.size
+        for i in range(templates):
+            count = COUNT.unpack_from(self.data, offset)[0]
+            self.templates.append((offset + COUNT.size, count))
+            offset += COUNT.size + count * EVENT.size
+        self.decoded = {}  # Template index: list of events
+        self.names = []
+        names = names_offset + COUNT.size
+        for i in range(COUNT.unpack_from(self.data, names_offset)[0]):
+            length = NAME.unpack_from(self.data, names)[0]
+            names += NAME.size
+            self.names.append(
+                self.data[names:names + length].decode("utf-8"))
+            names += length
+        # (template, name, time, shift, bpm) of every instance
+        self.instances = [INSTANCE.unpack_from(self.data, offset + i *
+                                               INSTANCE.size)
+                          for i in range(instances)]
+        self.count = None
+        self.sections = None
+
+    def template(self, index):
+        events = self.decoded.get(index)
+        if events is None:
+            offset, count = self.templates[index]
+            events = list(EVENT.iter_unpack(
+                self.data[offset:offset + count * EVENT.size]))
+            self.decoded[index] = events
+        return events
+
+    # Goes through the whole show once for its frame count and section
+    # times, which a section map doesn't store.
+    def scan(self):
+        self.count = 0
+        self.sections = []
+        for time, changes, channels, names, align in self.records():
+            self.count += 1
+            for name in names:
+                self.sections.append((to_micros(time), name))
+
+    def __len__(self):
+        if self.count is None:
+            self.scan()
+        return self.count
+
+    def __iter__(self):
+        for frame in self.records():
+            yield Frame(*frame)
+
+    # Times in seconds of every start of the named section, in order.
+    def section_times(self, name):
+        if self.sections is None:
+            self.scan()
+        return [micros / 1000000 for micros, section in self.sections
+                if section == name]
+
+    # Yields every frame the same way a lightmap with the same show would,
+    # without the keyframes to skip ahead with. Playback started partway
+    # through goes through every frame before start.
+    def frames(self):
+        instances = []
+        for template, name, time, shift, bpm in self.instances:
+            events = self.template(template)
+            # Templates are never empty.
+            first = time + (events[0][0] + shift) * 60 / bpm + \
+                events[0][1] * 60 / bpm
+            instances.append((first, partial(beat_events, events, time,
+                                             shift, bpm, self.names[name])))
+        resolver = FrameResolver(self.channels, self.margin)
+        frame = None
+        for cur, changes, names in resolver.frames(event_buckets(
+                merge_instances(instances), self.margin)):
+            if frame is not None:
+                yield frame
+            frame = (cur, changes, tuple(names))
+        if frame is not None:
+            # The last frame always turns every light off.
+            yield frame[0], [(channel, 1) for channel in
+                             range(self.channels)], ()
+
+    # Yields (time, changes, channels, names, align) for every frame, the
+    # same as Lightmap.records.
+    def records(self, start=None):
+        state = [0] * self.channels
+        if start is not None:
+            start = to_micros(start)
+        for time, changes, names in self.frames():
+            changes = tuple((channel, light) for channel, light in changes
+                            if light == 2 or light != state[channel])
+            if not changes and not names:
+                continue
+            micros = to_micros(time)
+            if start is not None and micros >= start:
+                # A frame right at the start becomes part of the first one.
+                merged = micros == start
+                if merged:
+                    for channel, light in changes:
+                        state[channel] = light
+                yield (start / 1000000, tuple(
+                    (channel, light) for channel, light in enumerate(state)
+                    if light != 0), self.channels, merged and names or (),
+                    merged and bool(names))
+                start = None
+                if merged:
+                    continue
+            for channel, light in changes:
+                state[channel] = light
+            if start is None:
+                yield micros / 1000000, changes, self.channels, names, \
+                    bool(names)
+        if start is not None:
+            # Started past the last frame.
+            yield (start / 1000000, tuple(
+                (channel, light) for channel, light in enumerate(state)
+                if light != 0), self.channels, (), False)
+
+    # Yields every frame in order with random lights settled, see settle.
+    def stream(self, probability=0.5, seed=None, chunk=256, start=None):
+        return settle(self.records(start), probability, seed, chunk)
+
+    def close(self):
+        if getattr(self, "data", None) is not None:
+            self.data.close()
+            self.data = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Opens a compiled lightmap, whether every frame is written out or it's a
+# section map.
+def open_lightmap(path):
+    with open(path, "rb") as data:
+        magic = data.read(4)
+    if magic == SECTION_MAGIC:
+        return SectionMap(path)
+    return Lightmap(path)
@@ -0,0 +1,155 @@
+"""
+Simulated playback for checking shows without waiting for them.
+
+A Simulation stands in for the clock, the pygame music player and the output
+and log threads, so the real player loop, with its alignment points and its
+corrections to stay on the music, runs on virtual time. Sleeping just moves the
+clock forward, so a song is played through in a fraction of its length, and
+the music can be made to drift, start late or report its position coarsely to
+see how the player copes.
+"""
+
+from time import perf_counter, sleep
+
+
+class SimClock:
+    # Virtual clock. Every reading moves it forward by step seconds, standing
+    # in for the time the player takes between readings, and sleeping moves
+    # it forward by however long was slept. If step is None, readings move it
+    # forward by the real time that passed since the last one instead, so
+    # the player's own work takes as long as it really does but sleeping is
+    # still skipped. If speed is set, sleeping also really sleeps, speed
+    # times faster than it would have.
+    def __init__(self, step=0.000001, speed=None):
+        self.now = 0
+        self.step = step
+        self.speed = speed
+        self.last = perf_counter()  # Real clock at the last reading
+
+    def __call__(self):
+        if self.step is None:
+            now = perf_counter()
+            self.now += now - self.last
+            self.last = now
+        else:
+            self.now += self.step
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        self.now += seconds
+        if self.speed is not None:
+            sleep(seconds / self.speed)
+        # Time really spent sleeping isn't counted twice.
+        self.last = perf_counter()
+
+
+class FakeMusic:
+    # Stands in for pygame.mixer.music. Music that's playing runs drift
+    # times faster than the clock, starts latency seconds after play is
+    # called and reports its position in steps of granularity seconds.
+    # Music lasts duration seconds, or until it's stopped if that's None.
+    def __init__(self, clock, duration=None, drift=1, latency=0,
+                 granularity=0.001):
+        self.clock = clock
+        self.duration = duration
+        self.drift = drift
+        self.latency = latency
+        self.granularity = granularity
+        self.volume = 1
+        self.started = None  # Clock reading play was called at
+        self.start = 0  # Seconds into the music play started at
+        self.queued = None  # Duration of the music queued up next
+
+    def load(self, file, hint=None):
+        self.stop()
+
+    def play(self, loops=0, start=0.0):
+        self.started = self.clock.now
+        self.start = start
+        self.queued = None
+
+    def stop(self):
+        self.started = None
+        self.queued = None
+
+    def queue(self, file, hint=None):
+        self.queued = self.duration
+
+    def set_volume(self, volume):
+        self.volume = volume
+
+    # Seconds the music has played since play was called.
+    def played(self):
+        if self.started is None:
+            return None
+        played = max(self.clock.now - self.started - self.latency, 0)
+        played *= self.drift
+        if self.duration is not None and \
+                self.start + played >= self.duration:
+            if self.queued is None:
+                self.started = None
+                return None
+            # Queued music takes over right where this one ended, with the
+            # position starting again from 0.
+            self.started += (self.duration - self.start) / self.drift
+            self.start = 0
+            self.duration = self.queued
+            self.queued = None
+            return self.played()
+        return played
+
+    def get_pos(self):
+        played = self.played()
+        if played is None:
+            return -1
+        return int(played // self.granularity * self.granularity * 1000)
+
+    def get_busy(self):
+        return self.played() is not None
+
+
+class Simulation:
+    # Runs in place of the output and log threads, writing frames and
+    # messages down with the time on the virtual clock instead.
+    def __init__(self, clock, music):
+        self.clock = clock
+        self.music = music
+        self.frames = []  # (clock reading, changes) of every frame written
+        self.messages = []  # (clock reading, message) of every message
+        # (clock reading, offset, shift) of every correction to the schedule
+        self.corrections = []
+        self.timing = None  # FrameTiming of the frames, set by the player
+
+    def start(self):
+        pass
+
+    def put(self, changes, index=None, wait=False):
+        self.frames.append((self.clock.now, changes))
+        return True
+
+    def log(self, message):
+        self.messages.append((self.clock.now, message))
+
+    def correct(self, offset, shift):
+        self.corrections.append((self.clock.now, offset, shift))
+
+    def close(self):
+        pass
+
+    def report(self):
+        offsets = [abs(c[1]) for c in self.corrections]
+        return {
+            "frames": [[round(time, 6), [list(change) for change in changes]]
+                       for time, changes in self.frames],
+            "corrections": [[round(time, 6), round(offset, 6),
+                             round(shift, 6)]
+                            for time, offset, shift in self.corrections],
+            "messages": [[round(time, 6), message]
+                         for time, message in self.messages],
+            "duration": round(self.clock.now, 6),
+            "max_offset": round(max(offsets, default=0), 6),
+            "timing": self.timing is not None and self.timing.summary() or
+            None,
+        }
@@ -0,0 +1,137 @@
+"""
+Per frame timing records and drift reports.
+
+While a song plays, the player writes down for every frame when it was due,
+how late it was released, how long writing it to the lights took and how far
+the lights were off the music. Everything goes into arrays set up a chunk at a
+time, so recording costs next to nothing while the lights keep time and
+neither has to know how many frames a song has nor copy what's recorded when
+it runs out of room.
+After the song the records are saved as a CSV file with a row per frame and a
+JSON summary with lateness percentiles and how the offset to the music drifted
+over the song, for tuning the sync settings to a venue.
+"""
+
+from array import array
+from json import dump
+from math import isnan
+from os import replace
+
+# Most points kept for the drift curve in the summary.
+DRIFT_POINTS = 100
+# Frames recorded in every chunk of the arrays, a power of 2.
+CHUNK = 4096
+
+
+# Value at fraction of the way through sorted values, or None if there are
+# none.
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def rounded(value, digits=6):
+    if value is None:
+        return None
+    return round(value, digits)
+
+
+class FrameTiming:
+    def __init__(self):
+        self.count = 0
+        # Chunks of CHUNK frames, each a list of four arrays:
+        # lightmap time the frame was due at,
+        # seconds late it was released,
+        # seconds the lights were ahead of the music and
+        # seconds writing it took, NaN if it was folded into a later frame.
+        self.chunks = []
+        self.grow()
+
+    def grow(self):
+        nan = array("d", [float("nan")])
+        self.chunks.append([nan * CHUNK for i in range(4)])
+
+    # Records a frame being released and returns its index.
+    def record(self, scheduled, late, offset):
+        index = self.count
+        chunk = index // CHUNK
+        if chunk == len(self.chunks):
+            self.grow()
+        columns = self.chunks[chunk]
+        index %= CHUNK
+        columns[0][index] = scheduled
+        columns[1][index] = late
+        columns[2][index] = offset
+        self.count += 1
+        return self.count - 1
+
+    # Records how long writing a frame took, from the output thread.
+    def wrote(self, index, seconds):
+        self.chunks[index // CHUNK][3][index % CHUNK] = seconds
+
+    # Array of one of the four columns of every frame recorded so far.
+    def column(self, which):
+        values = array("d")
+        for columns in self.chunks:
+            values.extend(columns[which])
+        return values[:self.count]
+
+    @property
+    def scheduled(self):
+        return self.column(0)
+
+    @property
+    def late(self):
+        return self.column(1)
+
+    @property
+    def offset(self):
+        return self.column(2)
+
+    @property
+    def write(self):
+        return self.column(3)
+
+    def summary(self, tolerance=None):
+        late = sorted(self.late)
+        write = sorted(w for w in self.write if not isnan(w))
+        offsets = self.offset
+        scheduled = self.scheduled
+        every = max(self.count // DRIFT_POINTS, 1)
+        summary = {
+            "frames": self.count,
+            "written": len(write),
+            "late": {name: rounded(percentile(late, fraction)) for
+                     name, fraction in (("p50", 0.5), ("p90", 0.9),
+                                        ("p99", 0.99), ("max", 1))},
+            "write": {name: rounded(percentile(write, fraction)) for
+                      name, fraction in (("p50", 0.5), ("p99", 0.99),
+                                         ("max", 1))},
+            "max_offset": rounded(max(map(abs, offsets), default=None)),
+            # (lightmap time, offset) through the song
+            "drift": [[rounded(scheduled[i]), rounded(offsets[i])]
+                      for i in range(0, self.count, every)],
+        }
+        if tolerance is not None:
+            summary["over_tolerance"] = sum(abs(o) > tolerance
+                                            for o in offsets)
+        return summary
+
+    # Writes path.csv with every frame and path.json with the summary and
+    # whatever settings are passed in.
+    def save(self, path, tolerance=None, **settings):
+        rows = zip(self.scheduled, self.late, self.write, self.offset)
+        with open(path + ".csv.tmp", "w") as out:
+            out.write("frame,scheduled,late,write,offset\n")
+            for i, (scheduled, late, write, offset) in enumerate(rows):
+                out.write("{},{:.6f},{:.6f},{},{:.6f}\n".format(
+                    i, scheduled, late,
+                    not isnan(write) and "{:.6f}".format(write) or "",
+                    offset))
+        replace(path + ".csv.tmp", path + ".csv")
+        summary = self.summary(tolerance)
+        summary["settings"] = settings
+        with open(path + ".json.tmp", "w") as out:
+            dump(summary, out)
+        replace(path + ".json.tmp", path + ".json")